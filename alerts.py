@@ -0,0 +1,352 @@
+import datetime
+import math
+
+TEMPERATURE_FIELD = 'temprature(deg celsius)'
+HUMIDITY_FIELD = 'humidity(%)'
+PHOTORESISTOR_FIELD = 'photoresistor(milivolt)'
+SCALE_FIELD = 'Scale Reading (grams)'
+
+DEFAULT_THRESHOLD_HOLD_SECONDS = 60 # A single bad DHT reading shouldn't send an alert
+DEFAULT_RATE_WINDOW_MINUTES = 10
+DEFAULT_BASELINE_DAYS = 7
+DEVIATING_READING_WEIGHT = 0.25 # see `BaselineDeviationRule`
+DEFAULT_LIGHT_MISMATCH_MINUTES = 5
+DEFAULT_SCALE_SILENT_MINUTES = 60
+DEFAULT_SCALE_MIN_WEIGHT = 1.0 # grams. Disconnected (or empty) scales read 0.
+DEFAULT_REPEAT_MINUTES = 60
+DEFAULT_RESOLVE_MINUTES = 5
+DEFAULT_MAX_ALERTS_PER_HOUR = 10
+
+# Every category of rules has its own rate limit, so a burst of scale alerts can't hold back a temperature alert.
+ENVIRONMENT_CATEGORY = "environment" # temperature & humidity
+LIGHT_CATEGORY = "light"
+SCALE_CATEGORY = "scale"
+
+
+def get_sample_value(sample, field, channel=None):
+    """
+    Return the value of `field` in a data sample (as returned by `get_arduino_data`), or None if it's missing / NaN.
+    For the scale field, `channel` picks the reading of a single scale out of the 8 readings.
+    """
+    value = sample.get(field)
+    if (value is not None) and (channel is not None):
+        value = value[channel] if channel < len(value) else None
+    if (value is None) or (value != value): # NaN != NaN
+        return None
+    return value
+
+
+class ThresholdRule:
+    """
+    Fires when a value is below `min_value` or above `max_value` (either can be None) for at least `hold_seconds`,
+    so a single glitched reading doesn't send an alert. Missing (NaN) readings don't reset the count.
+    """
+    def __init__(self, name, field, min_value=None, max_value=None, hold_seconds=DEFAULT_THRESHOLD_HOLD_SECONDS, channel=None):
+        self.name = name
+        self.field = field
+        self.channel = channel
+        self.min_value = min_value
+        self.max_value = max_value
+        self.hold_duration = datetime.timedelta(seconds=hold_seconds)
+        self.out_of_range_since = None
+        self.last_message = None
+        self.category = ENVIRONMENT_CATEGORY
+
+    def check(self, sample, now, light_state):
+        value = get_sample_value(sample, self.field, self.channel)
+        if value is None:
+            return self.last_message
+        message = None
+        if (self.min_value is not None) and (value < self.min_value):
+            message = f"{self.name} is {value}, below the minimum of {self.min_value}"
+        elif (self.max_value is not None) and (value > self.max_value):
+            message = f"{self.name} is {value}, above the maximum of {self.max_value}"
+
+        if message is None:
+            self.out_of_range_since = None
+        elif self.out_of_range_since is None:
+            self.out_of_range_since = now
+        if (message is not None) and (now - self.out_of_range_since >= self.hold_duration):
+            self.last_message = message
+        else:
+            self.last_message = None
+        return self.last_message
+
+
+class RateOfChangeRule:
+    """
+    Fires when a value changed by more than `max_change_per_hour` (in absolute value), measured over windows of
+    `window_minutes`. We only keep the value at the beginning of the current window, so single noisy readings
+    don't look like a fast change.
+    """
+    def __init__(self, name, field, max_change_per_hour, window_minutes=DEFAULT_RATE_WINDOW_MINUTES, channel=None):
+        self.name = name
+        self.field = field
+        self.channel = channel
+        self.max_change_per_hour = max_change_per_hour
+        self.window = datetime.timedelta(minutes=window_minutes)
+        self.window_start_value = None
+        self.window_start_time = None
+        self.last_message = None
+        self.category = ENVIRONMENT_CATEGORY
+
+    def check(self, sample, now, light_state):
+        value = get_sample_value(sample, self.field, self.channel)
+        if value is None:
+            return self.last_message
+        if self.window_start_time is None:
+            self.window_start_value, self.window_start_time = value, now
+            return None
+        elapsed = now - self.window_start_time
+        if elapsed < self.window:
+            return self.last_message
+
+        change_per_hour = (value - self.window_start_value) / (elapsed.total_seconds() / 3600)
+        self.window_start_value, self.window_start_time = value, now
+        if abs(change_per_hour) > self.max_change_per_hour:
+            self.last_message = f"{self.name} is changing by {change_per_hour:.1f} per hour (now {value}), faster than {self.max_change_per_hour} per hour"
+        else:
+            self.last_message = None
+        return self.last_message
+
+
+class BaselineDeviationRule:
+    """
+    Fires when a value deviates from its usual value at this hour of the day by more than `max_deviation`
+    standard deviations, for at least `hold_seconds`.
+
+    The baseline of every hour of the day is an exponentially weighted mean & variance, where every reading is
+    weighted by the time since the previous reading, so it "remembers" about the last `baseline_days` days.
+    Until an hour has `baseline_days` of data, the baseline is a plain (time weighted) average of all its readings.
+    An hour is only checked once it has at least one hour of data. Readings that deviate from the baseline are
+    added with `DEVIATING_READING_WEIGHT` of their weight, so a few hours of overheating barely move the baseline,
+    while a lasting change of the usual value becomes the new normal within a couple of days.
+    """
+    def __init__(self, name, field, max_deviation, baseline_days=DEFAULT_BASELINE_DAYS,
+                 hold_seconds=DEFAULT_THRESHOLD_HOLD_SECONDS, channel=None):
+        self.name = name
+        self.field = field
+        self.channel = channel
+        self.max_deviation = max_deviation
+        self.time_constant = baseline_days * 3600 # Every hour of the day gets one hour of data a day
+        self.hold_duration = datetime.timedelta(seconds=hold_seconds)
+        self.hourly_mean = [None] * 24
+        self.hourly_variance = [0.0] * 24
+        self.hourly_seconds = [0.0] * 24
+        self.last_time = None
+        self.deviating_since = None
+        self.last_message = None
+        self.category = ENVIRONMENT_CATEGORY
+
+    def check(self, sample, now, light_state):
+        value = get_sample_value(sample, self.field, self.channel)
+        if value is None:
+            return self.last_message
+        hour = now.hour
+        seconds = 0 if self.last_time is None else min((now - self.last_time).total_seconds(), 60)
+        self.last_time = now
+
+        mean = self.hourly_mean[hour]
+        if mean is None:
+            self.hourly_mean[hour] = value
+            return None
+
+        std = math.sqrt(self.hourly_variance[hour])
+        # Once deviating, the value has to come back within 3/4 of `max_deviation`, so a value near the limit doesn't flap.
+        max_deviation = self.max_deviation if self.deviating_since is None else 0.75 * self.max_deviation
+        deviating = (self.hourly_seconds[hour] >= 3600) and (std > 0) and (abs(value - mean) > max_deviation * std)
+        if not deviating:
+            self.deviating_since = None
+        elif self.deviating_since is None:
+            self.deviating_since = now
+        if deviating and (now - self.deviating_since >= self.hold_duration):
+            self.last_message = f"{self.name} is {value}, while it is usually {mean:.1f} ± {std:.1f} at {hour}:00"
+        else:
+            self.last_message = None
+
+        # Update the baseline of this hour with the new value
+        self.hourly_seconds[hour] += seconds
+        if self.hourly_seconds[hour] == 0:
+            return self.last_message
+        alpha = seconds / min(self.hourly_seconds[hour], self.time_constant)
+        if deviating:
+            alpha *= DEVIATING_READING_WEIGHT
+        difference = value - mean
+        self.hourly_mean[hour] = mean + alpha * difference
+        self.hourly_variance[hour] = (1 - alpha) * (self.hourly_variance[hour] + alpha * difference ** 2)
+        return self.last_message
+
+
+class LightMismatchRule:
+    """
+    Fires when the photoresistor disagrees with the last light command (ON/OFF) for more than `mismatch_minutes`,
+    i.e. the light failed to switch. The light is considered on when the photoresistor reads above `on_threshold`.
+    """
+    def __init__(self, name, on_threshold, mismatch_minutes=DEFAULT_LIGHT_MISMATCH_MINUTES):
+        self.name = name
+        self.on_threshold = on_threshold
+        self.mismatch_duration = datetime.timedelta(minutes=mismatch_minutes)
+        self.mismatch_since = None
+        self.category = LIGHT_CATEGORY
+
+    def check(self, sample, now, light_state):
+        value = get_sample_value(sample, PHOTORESISTOR_FIELD)
+        if (value is None) or (light_state is None):
+            return None
+        measured_state = "ON" if value > self.on_threshold else "OFF"
+        if measured_state == light_state:
+            self.mismatch_since = None
+            return None
+        if self.mismatch_since is None:
+            self.mismatch_since = now
+        if now - self.mismatch_since >= self.mismatch_duration:
+            return f"{self.name}: light was commanded {light_state} but the photoresistor reads {value} (light is {measured_state}) since {self.mismatch_since.strftime('%H:%M')}"
+        return None
+
+
+class ScaleSilentRule:
+    """
+    Fires when the scales of one or more monitored birds have no valid reading (above `min_weight`) for more than
+    `silent_minutes`. `birds` maps the scale channel to the bird's name. All scales are checked by a single rule,
+    so e.g. a disconnected scale system sends one alert instead of one alert per bird.
+    """
+    def __init__(self, name, birds, silent_minutes=DEFAULT_SCALE_SILENT_MINUTES, min_weight=DEFAULT_SCALE_MIN_WEIGHT):
+        self.name = name
+        self.birds = birds
+        self.silent_duration = datetime.timedelta(minutes=silent_minutes)
+        self.min_weight = min_weight
+        self.last_valid_times = {channel: None for channel in birds}
+        self.category = SCALE_CATEGORY
+
+    def check(self, sample, now, light_state):
+        silent_birds = []
+        for channel, bird in self.birds.items():
+            value = get_sample_value(sample, SCALE_FIELD, channel)
+            if (self.last_valid_times[channel] is None) or ((value is not None) and (value > self.min_weight)):
+                self.last_valid_times[channel] = now
+            elif now - self.last_valid_times[channel] >= self.silent_duration:
+                silent_birds.append(f"'{bird}' (channel {channel}) since {self.last_valid_times[channel].strftime('%Y-%m-%d %H:%M')}")
+        if len(silent_birds) == 0:
+            return None
+        return f"{self.name} had no valid reading - {', '.join(silent_birds)}"
+
+
+class AlertEngine:
+    """
+    Evaluates all rules on every data sample and sends alerts with `send_alert(message)`, which returns whether
+    the message was sent. A message that failed to send is tried again on the next sample.
+
+    * Deduplication - an alert is sent when a rule starts firing, and repeated at most every `repeat_minutes`
+      while it keeps firing. Once the rule stopped firing for `resolve_minutes`, a "resolved" message is sent.
+    * Rate limiting - at most `max_alerts_per_hour` messages are sent per category of rules (a token bucket for
+      environment, light and scale rules each). A message over the limit isn't sent, and is tried again on the
+      next samples until it goes out (or the rule stops firing). The next message that is sent says how many
+      alerts were held back.
+    """
+    def __init__(self, rules, send_alert, env_system=0, repeat_minutes=DEFAULT_REPEAT_MINUTES,
+                 resolve_minutes=DEFAULT_RESOLVE_MINUTES, max_alerts_per_hour=DEFAULT_MAX_ALERTS_PER_HOUR):
+        self.rules = rules
+        self.send_alert = send_alert
+        self.env_system = env_system
+        self.repeat_duration = datetime.timedelta(minutes=repeat_minutes)
+        self.resolve_duration = datetime.timedelta(minutes=resolve_minutes)
+        self.max_alerts_per_hour = max_alerts_per_hour
+        self.buckets = {rule.category: {"tokens": max_alerts_per_hour, "last_refill_time": None, "held_back_count": 0}
+                        for rule in rules}
+        # For every rule - when the last alert was sent (None if it isn't firing), since when it is clear,
+        # and whether its current message is held back by the rate limit.
+        self.rule_states = {rule.name: {"last_sent": None, "clear_since": None, "held_back": False} for rule in rules}
+
+    def evaluate(self, sample, now, light_state=None):
+        for rule in self.rules:
+            message = rule.check(sample, now, light_state)
+            state = self.rule_states[rule.name]
+            if message is not None:
+                state["clear_since"] = None
+                if (state["last_sent"] is None) or (now - state["last_sent"] >= self.repeat_duration):
+                    if self.send_or_hold_back(f"ALERT in enviromental system {self.env_system} - {message}", now, rule, state):
+                        state["last_sent"] = now
+            elif state["last_sent"] is not None:
+                if state["clear_since"] is None:
+                    state["clear_since"] = now
+                if now - state["clear_since"] >= self.resolve_duration:
+                    if self.send_or_hold_back(f"RESOLVED in enviromental system {self.env_system} - {rule.name} is back to normal", now, rule, state):
+                        state["last_sent"] = None
+                        state["clear_since"] = None
+            else:
+                state["held_back"] = False # The rule stopped firing before its alert was sent
+
+    def send_or_hold_back(self, message, now, rule, state):
+        """
+        Send the message of `rule` if its category's rate limit allows it. Returns True if the message was sent.
+        A held back message is only counted (and printed) once, although it is tried again on every sample.
+        """
+        bucket = self.buckets[rule.category]
+        if self.send(message, now, bucket):
+            state["held_back"] = False
+            return True
+        if bucket["tokens"] >= 1:
+            return False # Sending failed (not the rate limit), so the alert is tried again on the next sample
+        if not state["held_back"]:
+            state["held_back"] = True
+            bucket["held_back_count"] += 1
+            print(f"\tAlert rate limit reached, holding back - {message}")
+        return False
+
+    def send(self, message, now, bucket):
+        """
+        Send the message if the token `bucket` has a token left. Returns True if the message was sent.
+        If `send_alert` fails (returns False) the token is given back, so a failed post doesn't use up the rate limit.
+        """
+        if bucket["last_refill_time"] is not None:
+            refill = (now - bucket["last_refill_time"]).total_seconds() * self.max_alerts_per_hour / 3600
+            bucket["tokens"] = min(self.max_alerts_per_hour, bucket["tokens"] + refill)
+        bucket["last_refill_time"] = now
+
+        if bucket["tokens"] < 1:
+            return False
+        if bucket["held_back_count"] > 0:
+            message = f"{message} ({bucket['held_back_count']} alerts were held back by the rate limit)"
+        print(f"\t{message}")
+        if not self.send_alert(message):
+            return False
+        bucket["tokens"] -= 1
+        bucket["held_back_count"] = 0
+        return True
+
+
+def build_alert_engine(config_data, bird_catalog, send_alert):
+    """
+    Create the alert engine from the `alert...` keys of the config file. Rules whose keys are empty are not created.
+    Returns None if no rule is configured.
+    """
+    rules = []
+    hold_seconds = config_data.get("alertThresholdHoldSeconds")
+    if hold_seconds is None:
+        hold_seconds = DEFAULT_THRESHOLD_HOLD_SECONDS
+
+    for name, field, key in [("Temperature", TEMPERATURE_FIELD, "Temperature"), ("Humidity", HUMIDITY_FIELD, "Humidity")]:
+        min_value = config_data.get(f"alertMin{key}")
+        max_value = config_data.get(f"alertMax{key}")
+        if (min_value is not None) or (max_value is not None):
+            rules.append(ThresholdRule(name, field, min_value=min_value, max_value=max_value, hold_seconds=hold_seconds))
+        if config_data.get(f"alertMax{key}ChangePerHour") is not None:
+            rules.append(RateOfChangeRule(f"{name} change", field, config_data[f"alertMax{key}ChangePerHour"]))
+        if config_data.get(f"alert{key}BaselineDeviation") is not None:
+            rules.append(BaselineDeviationRule(f"{name} baseline", field, config_data[f"alert{key}BaselineDeviation"],
+                                               baseline_days=config_data.get("alertBaselineDays") or DEFAULT_BASELINE_DAYS,
+                                               hold_seconds=hold_seconds))
+
+    if config_data.get("alertLightOnPhotoresistorThreshold") is not None:
+        rules.append(LightMismatchRule("Light switch", config_data["alertLightOnPhotoresistorThreshold"],
+                                       mismatch_minutes=config_data.get("alertLightMismatchMinutes") or DEFAULT_LIGHT_MISMATCH_MINUTES))
+
+    birds = {i: bird_catalog[f"channel{i}"] for i in range(8) if bird_catalog.get(f"channel{i}") is not None}
+    if (config_data.get("alertScaleSilentMinutes") is not None) and (len(birds) > 0):
+        rules.append(ScaleSilentRule("Bird scales", birds, silent_minutes=config_data["alertScaleSilentMinutes"]))
+
+    if len(rules) == 0:
+        return None
+    return AlertEngine(rules, send_alert, env_system=config_data.get('env_system', 0),
+                       repeat_minutes=config_data.get("alertRepeatMinutes") or DEFAULT_REPEAT_MINUTES,
+                       max_alerts_per_hour=config_data.get("alertMaxPerHour") or DEFAULT_MAX_ALERTS_PER_HOUR)
@@ -0,0 +1,40 @@
+import datetime
+import time
+
+
+class SystemClock:
+    """
+    The real wall clock. This is the default clock of the control script.
+    """
+    def now(self):
+        return datetime.datetime.now()
+
+    def today(self):
+        return datetime.date.today()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SimulatedClock:
+    """
+    A virtual clock for replaying the control loop faster than real time.
+    Time only moves when someone calls `sleep` (or `advance`), which returns immediately.
+    """
+    def __init__(self, start_time):
+        self.current_time = start_time
+
+    def now(self):
+        return self.current_time
+
+    def today(self):
+        return self.current_time.date()
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.current_time += datetime.timedelta(seconds=seconds)
+
+
+SYSTEM_CLOCK = SystemClock()
@@ -1,11 +1,12 @@
 import datetime
 import sys
 import os
-import time
 import yaml 
 from zoneinfo import ZoneInfo
 from argparse import ArgumentParser
 import glob
+import csv
+import statistics
 import astral
 from astral.sun import sun
 import serial
@@ -15,6 +16,9 @@ from slack_sdk.errors import SlackApiError
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from tracing import span, start_tracing, enable_profile_on_signal, DEFAULT_PROFILE_SECONDS
+from clock import SYSTEM_CLOCK
+from alerts import build_alert_engine
 
 WEIZMANN_LAT = 31.905111
 WEIZMANN_LONG = 34.808349
@@ -50,6 +54,18 @@ OFF_TOKEN = b'a'
 
 LAST_LIGHT_SWITCH_STATE = None
 
+# Sunrise & sunset times only change once a day, but `handle_lights` needs them every minute.
+# We keep the times calculated for every (location, date) pair here, so astral runs once a day.
+SUN_TIMES_CACHE = {}
+
+# The header and size of every csv report we appended to, so we don't need to re-read the header every minute.
+# If the size of the report changed since our last write (e.g. it was replaced), we read the header again.
+REPORT_HEADERS_CACHE = {}
+
+# The number of lines we try to read from the Arduino when we need a single valid reading (see `get_latest_arduino_data`).
+# Every read waits up to the serial port timeout (1 second), and the Arduino sends a line about every second.
+LATEST_DATA_MAX_READS = 5
+
 # These are the names of the CSV columns.
 # NOTE - The last column must be dateTime, since we're counting the rest of the fields to verify
 # the data vailidity!
@@ -92,7 +108,7 @@ def get_weizmann_location_object():
     return location_object
 
 
-def get_sun_times_by_offset(city: astral.LocationInfo, days_offset: int = 0,Hours_offset: int =0):
+def get_sun_times_by_offset(city: astral.LocationInfo, days_offset: int = 0,Hours_offset: int =0, clock=SYSTEM_CLOCK):
     """
     Receive a city (LocationInfo object) and return the sunrise & sunset times, for the current date.
 
@@ -100,13 +116,9 @@ def get_sun_times_by_offset(city: astral.LocationInfo, days_offset: int = 0,Hour
     in our date calculation
     """
 
-    date = datetime.date.today() + datetime.timedelta(days=days_offset) 
+    date = clock.today() + datetime.timedelta(days=days_offset) 
 
-    sun_info = sun(city.observer, date=date, tzinfo=ZoneInfo(TIMEZONE_NAME))
-    sunrise_time = sun_info["sunrise"]
-    sunset_time = sun_info["sunset"]
-
-    return (sunrise_time, sunset_time)
+    return get_sun_times_by_day(city, date)
 
 
 def get_sun_times_by_day(city: astral.LocationInfo, date: datetime.datetime.now()):
@@ -114,31 +126,46 @@ def get_sun_times_by_day(city: astral.LocationInfo, date: datetime.datetime.now(
     Receive a city (LocationInfo object) and return the sunrise & sunset times, for a desierd date.
     it's default is today's date
     """
+    cache_key = (city.name, city.latitude, city.longitude, date)
+    if cache_key in SUN_TIMES_CACHE:
+        return SUN_TIMES_CACHE[cache_key]
 
     sun_info = sun(city.observer, date=date, tzinfo=ZoneInfo(TIMEZONE_NAME))
     sunrise_time = sun_info["sunrise"]
     sunset_time = sun_info["sunset"]
 
+    if date is not None: # A None date means "today" for astral, so it can't be cached
+        SUN_TIMES_CACHE[cache_key] = (sunrise_time, sunset_time)
     return (sunrise_time, sunset_time)
     
 
-def send_to_slack(slack_client, is_on, time):
+def send_to_slack(slack_client, is_on, time, env_system=0):
     """
     Send a message to 'monitor_alerts' channel in slack when the light is turned on and off in every environmental system.
     The channel is defined by the 'SLACK_CHANNEL_ID' variable and the bot sending the file is defined by 'slack_client' variable which contains the bot's "token" ('SLACK_TOKEN').
     """
-    env_system=config_data.get('env_system',0)
     if is_on:
         msg = f"Light was turned ON at {time}, in enviromental system {env_system}"
     else:
         msg = f"Light was turned OFF at {time}, in enviromental system {env_system}"
 
+    send_message_to_slack(slack_client, msg)
+
+
+def send_message_to_slack(slack_client, msg):
+    """
+    Send a text message to the 'monitor_alerts' channel in slack (light switch messages, environmental alerts).
+    Returns True if the message was posted.
+    """
     try:
-        result = slack_client.chat_postMessage(channel=SLACK_CHANNEL_ID, text=msg)
+        with span("send_to_slack"):
+            result = slack_client.chat_postMessage(channel=SLACK_CHANNEL_ID, text=msg)
         if result.status_code != 200:
             raise Exception(f"Failed sending Slack message, response code = {result.status_code}")
     except Exception as err:
         print(f"Failed sending Slack message - {msg}")
+        return False
+    return True
 
 
 def send_file_to_slack(slack_client, file_path):
@@ -151,7 +178,7 @@ def send_file_to_slack(slack_client, file_path):
         # Check if the file exists
         if os.path.isfile(file_path):
             # Read the file content
-            with open(file_path, "rb") as file_content:
+            with open(file_path, "rb") as file_content, span("send_file_to_slack", file=os.path.basename(file_path)):
             # Upload the file
                 result = slack_client.files_upload_v2(
                     file=file_content,
@@ -177,23 +204,27 @@ def read_config(path):
         raise Exception(f"Failed reading file `{path}` - {err}")    
 
 
-def data_aggregation(list_of_data_points):
+def data_aggregation(list_of_data_points, clock=SYSTEM_CLOCK):
     """
     Receive a list of data points, where each datapoint is a dictionary, e.g. - 
         {"humidity": 6, "temp": 1.3, "photoresistor": 800}
     
     and return an aggregated dictionary, with the minimum, maximum and median values for each category - 
     {"min_humidity": ___..., "max_humidity": ___... , "median_humidity": ___ , ...} and so on for all values of the original dictionary
-    """
-    df = pd.DataFrame(list_of_data_points)
 
+    This runs every minute on ~60 data points, so we use plain python instead of building a pandas DataFrame.
+    NaN readings (e.g. a failed DHT reading) are skipped.
+    """
     aggregated_data = {}
     try:
         for field in CSV_FIELD_NAMES:
             if (field != "dateTime") and (field != 'Scale Reading (grams)'): 
-                aggregated_data[f"{field}_min"] = str(df[field].min())
-                aggregated_data[f"{field}_max"] = str(df[field].max())
-                aggregated_data[f"{field}_median"] = str(df[field].median())
+                values = [data_point[field] for data_point in list_of_data_points if data_point[field] == data_point[field]]
+                if len(values) == 0:
+                    values = [float("nan")]
+                aggregated_data[f"{field}_min"] = str(min(values))
+                aggregated_data[f"{field}_max"] = str(max(values))
+                aggregated_data[f"{field}_median"] = str(statistics.median(values))
     except Exception as err:
         print(f"Failed aggregating data - ")
         print(list_of_data_points)
@@ -201,17 +232,17 @@ def data_aggregation(list_of_data_points):
         print("ERROR -")
         print(err)
 
-    current_time = datetime.datetime.now().strftime(strf_format)
+    current_time = clock.now().strftime(strf_format)
     aggregated_data["dateTime"] = current_time
 
     return aggregated_data
 
-def get_arduino_data(serial_device):
+def get_arduino_data(serial_device, clock=SYSTEM_CLOCK):
     """
     Read & parse sensor data from the arduino device (via the serial port).
     We return a dict with the parsed data from the sensors.
     """
-    current_time = datetime.datetime.now()
+    current_time = clock.now()
     formatted_time = current_time.strftime("%Y_%m_%d_%H_%M_%S.%f")
 
     try:
@@ -236,6 +267,22 @@ def get_arduino_data(serial_device):
     return dict(tuples)
 
 
+def get_latest_arduino_data(serial_device, clock=SYSTEM_CLOCK):
+    """
+    Read a fresh data sample from the arduino, when the script doesn't read it continuously (so the serial input
+    buffer holds old readings). We drop the buffered data and the (possibly partial) line that follows it.
+    A read can time out (or fail parsing) before the next line arrives, so we try up to `LATEST_DATA_MAX_READS` lines,
+    and return None if none of them was valid.
+    """
+    serial_device.reset_input_buffer()
+    serial_device.readline()
+    for _ in range(LATEST_DATA_MAX_READS):
+        data = get_arduino_data(serial_device, clock=clock)
+        if data is not None:
+            return data
+    return None
+
+
 def parse_arduino_data(arduino_raw_data):
     """
     this function accepts raw data from the serial port arduino it is connected to and edit it such that we will get numbers, with no space between lines.
@@ -297,13 +344,13 @@ def parse_sunrise_sunset(set_time):
         return None
     return set_time_obj
 
-def handle_lights(serial_device, config_data, wis_location_info, slack_client):
+def handle_lights(serial_device, config_data, wis_location_info, slack_client, clock=SYSTEM_CLOCK):
     """
     Receive the serial device object, and use it to turn the lights on/off.
     The logic behind this is documented at the beginning of the code.
     """
     light_switch_status = LAST_LIGHT_SWITCH_STATE
-    current_time = datetime.datetime.now()
+    current_time = clock.now()
 
 
     days_offset = config_data.get("days_offset", 0)
@@ -330,7 +377,7 @@ def handle_lights(serial_device, config_data, wis_location_info, slack_client):
         
     elif type(days_offset) == type(1):
         print(f"\tCalculating sun times with a delay of `{days_offset}` ")
-        sunrise_time, sunset_time = get_sun_times_by_offset(wis_location_info, days_offset, )
+        sunrise_time, sunset_time = get_sun_times_by_offset(wis_location_info, days_offset, clock=clock)
         sunrise_time=sunrise_time.time()
         sunset_time=sunset_time.time()
     elif not ((sunrise is not None) & (sunset is not None)):
@@ -357,26 +404,26 @@ def handle_lights(serial_device, config_data, wis_location_info, slack_client):
         print(f"Light turned on!")
 
         if light_switch_status == "OFF" or light_switch_status is None:
-            send_to_slack(slack_client, is_on=True, time=current_time)
+            send_to_slack(slack_client, is_on=True, time=current_time, env_system=config_data.get('env_system', 0))
             light_switch_status = "ON"
     else:
         print("Lights stay off!")
         serial_device.write(OFF_TOKEN)
         
         if light_switch_status == "ON" or light_switch_status is None:
-            send_to_slack(slack_client, is_on=False, time=current_time)
+            send_to_slack(slack_client, is_on=False, time=current_time, env_system=config_data.get('env_system', 0))
             light_switch_status = "OFF"
     
     return light_switch_status
 
 
-def create_filename_for_data_report(config_data, time_format="%Y_%m_%d"):
+def create_filename_for_data_report(config_data, time_format="%Y_%m_%d", clock=SYSTEM_CLOCK):
     ''' 
 
     Create the file name of the saved report based on the given parameters and time format
 
     '''
-    curr_time = datetime.datetime.now().strftime(time_format)
+    curr_time = clock.now().strftime(time_format)
     days_offset = config_data.get("days_offset", 0)
     stable_date=config_data.get("stable_date", 0)
     if stable_date is not None:
@@ -462,6 +509,58 @@ def find_single_csv_file(path_to_dir, name_type='full'):
             return os.path.basename(files[0])
 
 
+def append_to_csv_report(rows, field_names, path_to_file):
+    """
+    Append `rows` (a list of dicts) to the csv report in `path_to_file`, creating it with the `field_names` header
+    (and its folder) if it doesn't exist. Returns True if a new report was created.
+
+    We only append the new rows instead of reading & re-writing the whole report, so the time this takes
+    doesn't grow with the report. The new rows are ordered by the header of the existing report.
+    If the new rows have columns that the existing report doesn't have, the report is re-written once with these
+    columns added at the end (and left empty in the old rows), like `pd.concat` of the old and new data would do.
+    """
+    cached_field_names, cached_size = REPORT_HEADERS_CACHE.get(path_to_file, (None, None))
+    try:
+        if (cached_size is not None) and (os.path.getsize(path_to_file) == cached_size):
+            existing_field_names = cached_field_names
+        else:
+            with open(path_to_file, "r", newline="") as f:
+                existing_field_names = next(csv.reader(f), None)
+    except FileNotFoundError:
+        existing_field_names = None
+        os.makedirs(os.path.dirname(path_to_file) or ".", exist_ok=True)
+
+    if existing_field_names is not None:
+        new_field_names = [name for name in dict.fromkeys(list(field_names) + [key for row in rows for key in row])
+                           if name not in existing_field_names]
+        if len(new_field_names) > 0:
+            rewrite_csv_report_with_new_columns(rows, existing_field_names + new_field_names, path_to_file)
+            return False
+
+    with open(path_to_file, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=existing_field_names or field_names, lineterminator=os.linesep)
+        if existing_field_names is None:
+            writer.writeheader()
+        writer.writerows(rows)
+        REPORT_HEADERS_CACHE[path_to_file] = (writer.fieldnames, f.tell())
+    return existing_field_names is None
+
+
+def rewrite_csv_report_with_new_columns(rows, field_names, path_to_file):
+    """
+    Re-write the csv report in `path_to_file` with the (extended) `field_names` header, followed by the new `rows`.
+    The report is written to a temporary file first and then replaces the old one, so a crash never loses data.
+    """
+    temp_filename = path_to_file + ".tmp"
+    with open(path_to_file, "r", newline="") as old_file, open(temp_filename, "w", newline="") as new_file:
+        writer = csv.DictWriter(new_file, fieldnames=field_names, lineterminator=os.linesep)
+        writer.writeheader()
+        writer.writerows(csv.DictReader(old_file))
+        writer.writerows(rows)
+    os.replace(temp_filename, path_to_file)
+    REPORT_HEADERS_CACHE[path_to_file] = (field_names, os.path.getsize(path_to_file))
+
+
 def concat_data_in_folder(path_to_dir):
     files = sorted(glob.glob(path_to_dir + '/*.csv')) # Gives the whole path to each file in the directory
     scale_data = pd.read_csv(files[0])
@@ -471,89 +570,64 @@ def concat_data_in_folder(path_to_dir):
     return scale_data
 
 
-if __name__ == "__main__":
-    print("Hello! This is the Arduino controller script!\n")
-
-    ## Part 1 - parse the config file
-    parser = ArgumentParser()
-
-    # `config` actually IS a required variable, but this way it'll be easier to raise a custom error when it isn't supplied
-    parser.add_argument("--config", required=False, help="The path for the config file we're working with.")
-    args = parser.parse_args()
-
-    config_path = args.config
-    config_path = r'/Users/cohenlab/Documents/GitHub_Yuval/acoustic_chamber_environment_control/config_files/config_1.yaml'
-    if config_path is None:
-        raise Exception("No config file was supplied! Please rerun and add `--config=/path/to/config` ")
-
-    config_data = read_config(config_path)
-    print(f"Working with config file `{config_path}`, which contains - ")
-    print(yaml.dump(config_data)) # This is just a trick to print the YAML content in a nicer way
-
-    ## Part 2 - Initialize Slack
-    try:
-        slack_client = WebClient(token=SLACK_TOKEN)
-        print("\tSuccessfully initialized Slack client")
-    except Exception as err:
-        print(f"Failed initializing Slack client - `{err}`")
-        sys.exit(1)
-        
-    ## Part 3 - Connect to the serial device
-    try:
-        serial_device = get_serial_device()
-        print("\tSuccessfully connected to Serial device")
-    except Exception as err:
-        print(f"Failed connecting to the Serial device - `{err}`")
-        sys.exit(1)
-    
-    ## Part 4 - Initialize a Weizmann location object for the Astral package
-    try:
-        wis_location_info = get_weizmann_location_object()
-        print("\tSuccessfully initialized the location object for WIS")
-    except Exception as err:
-        print(f"Failed initializing the location object - `{err}`")
-        sys.exit(1)
-    
-    print("\n")
-
-    ## Part 5 - This is the main part of the code, which runs in a loop and reads data from sensors, and controls the light switch.
+def run_control_loop(config_data, serial_device, wis_location_info, slack_client, clock=SYSTEM_CLOCK, sample_interval=1, until=None, on_cycle=None,
+                     write_report=append_to_csv_report):
+    """
+    The main loop of the script - reads data from the sensors & scales, controls the light switch, saves the data reports
+    and sends them to slack, based on the config file.
+
+    By default it runs forever against the real clock. `clock`, `until` and `on_cycle` let us replay the loop against
+    a simulated clock (see `simulate_control_loop.py`) - the loop stops once `clock.now()` passes `until`, and
+    `on_cycle` (if given) is called at the end of every cycle.
+    `sample_interval` is the number of seconds to sleep between two readings of the Arduino within a minute.
+    `write_report` saves new rows to a report, with the arguments and return value of `append_to_csv_report`.
+    """
+    global LAST_LIGHT_SWITCH_STATE
 
     scale_readings = [] # This array will hande temporary scale data and will be reset once the defined time is over
     
     temp_sensor_data = [] # This array will handle the temporary sensor data, and will be reset once the defined time is over
     daily_sensor_data = pd.DataFrame() # This array will handle daily sensor data and will be reset once a day is over
 
-    temp_loop_start_time = datetime.datetime.now()
-    day_loop_start_time = datetime.datetime.now()
+    temp_loop_start_time = clock.now()
+    day_loop_start_time = clock.now()
 
     if config_data["sendWeightReportToSlackTime"] is not None:
-        last_slacking_time = datetime.datetime.now() # This timestamp will help indicate if we need to send the weight report to slack
+        last_slacking_time = clock.now() # This timestamp will help indicate if we need to send the weight report to slack
         # Read user settings for time to send daily weight report to slack in HH:MM
         target_hour = int(config_data["sendWeightReportToSlackTime"][0:2])  # Example: 14 for 2 PM
         target_minute = int(config_data["sendWeightReportToSlackTime"][3:])  # Example: 30 for 2:30 PM
 
+    bird_catalog = dict()
     if config_data["scaleDataReadingAndSaving"]: # If user chose to collect scale data, print the bird catalog (which bird is connected to which channel).
-        bird_catalog = dict()
         for i in range(8):
             bird_id = config_data.get(f"channel{i}", 0)
             bird_catalog[f"channel{i}"] = bird_id
             print(f"bird connected to channel{i}: {bird_id}")
         print("\n")
+
+    # Environmental alerts are evaluated on every reading from the Arduino (see `alerts.py` and the `alert...` config keys)
+    alert_engine = build_alert_engine(config_data, bird_catalog, send_alert=lambda msg: send_message_to_slack(slack_client, msg))
+    if (alert_engine is not None) and not (config_data["sensorDataReadingAndSaving"] or config_data["scaleDataReadingAndSaving"]):
+        print("\tData saving is off, so alerts are checked on a single Arduino reading every minute. "
+              "This needs an Arduino code that sends the sensor data (e.g. `arduino_code_1`).")
     
-    while True: 
-        while serial_device.in_waiting == 0: 
-            pass 
+    while (until is None) or (clock.now() < until): 
+        with span("wait_for_serial"):
+            while serial_device.in_waiting == 0: 
+                pass 
         
         # Part 5.1 - Handle the lights! Turn the lights on/off, and update our state variable based on the action
-        LAST_LIGHT_SWITCH_STATE = handle_lights(serial_device, config_data, wis_location_info, slack_client)
+        with span("handle_lights"):
+            LAST_LIGHT_SWITCH_STATE = handle_lights(serial_device, config_data, wis_location_info, slack_client, clock=clock)
 
         # Part 5.2 - Read & aggregate data from the sensor
-        current_time = datetime.datetime.now()
+        current_time = clock.now()
         print(f"Current UTC time is {current_time}\n")
 
         data_from_last_minute = []
 
-        minute_loop_start_time = datetime.datetime.now()
+        minute_loop_start_time = clock.now()
         
        
         if config_data["sensorDataReadingAndSaving"] or config_data["scaleDataReadingAndSaving"]:
@@ -573,27 +647,33 @@ if __name__ == "__main__":
             '''
             #**********COLLECT DATA FOR 1 MINUTE**********
             while True:
-                data = get_arduino_data(serial_device)
+                with span("get_arduino_data"):
+                    data = get_arduino_data(serial_device, clock=clock)
                 # print("get arduino data: ", data)
                 if data is None: # There was an error, moving on and ignoring this specific read
                     continue
+
+                if alert_engine is not None:
+                    with span("alerts"):
+                        alert_engine.evaluate(data, clock.now(), light_state=LAST_LIGHT_SWITCH_STATE)
                 
                 if config_data["scaleDataReadingAndSaving"]:
                     scale = data.get('Scale Reading (grams)')
-                    scale_readings.append([datetime.datetime.now().strftime(scale_report_strf_time_format), scale])
+                    scale_readings.append([clock.now().strftime(scale_report_strf_time_format), scale])
                    
                 # In the multiscale version, we need to separate the scale readings from the agg. data dict here because it is now a list of 8 values and cannot be used in data_aggregation
                 data_for_agg = {key: data[key] for key in data.keys() & {'dateTime','humidity(%)','temprature(deg celsius)','photoresistor(milivolt)'}}
                 # print("data for agg = ", data_for_agg)
                 data_from_last_minute.append(data_for_agg) # changed data --> data_for_agg in multiscale version does not include scale data
 
-                if (datetime.datetime.now() - minute_loop_start_time).seconds >= 60:
+                if (clock.now() - minute_loop_start_time).seconds >= 60:
                     print("\tFinished collecting data for 1 minute")
                     break
-                time.sleep(1)
+                clock.sleep(sample_interval)
             
             # After we recorded data for 1 minute, we aggregate it and store in the temporary array.
-            aggregated_data = data_aggregation(data_from_last_minute)
+            with span("data_aggregation", n_data_points=len(data_from_last_minute)):
+                aggregated_data = data_aggregation(data_from_last_minute, clock=clock)
             print("\tSuccessfully aggregated data\n")
             temp_sensor_data.append(aggregated_data) ## Maybe we don;t need that
 			
@@ -603,32 +683,24 @@ if __name__ == "__main__":
                 print(f"\tWriting sensor data to disk...")
                 
                 # Create the name of the saved report based on the current parameters
-                file_name = create_filename_for_data_report(config_data, time_format="%Y_%m_%d")
+                file_name = create_filename_for_data_report(config_data, time_format="%Y_%m_%d", clock=clock)
 
-                # Generate path and save the file (create temporary files folder if neccesary)
+                # Generate path and save the file (the folder is created with the first report, if neccesary)
                 sensor_data_base_path = os.path.join(config_data["sensorOutputBasePath"], "sensor_data")
-                os.makedirs(sensor_data_base_path, exist_ok=True)
                 
                 sensor_data_filename = os.path.join(sensor_data_base_path, file_name)
                 
-                new_sensor_data_df = pd.DataFrame(temp_sensor_data)
-
                 # Re-arrange columns so that the time will appear first
-                columns_order = ['dateTime'] + [col for col in new_sensor_data_df.columns if col != 'dateTime']
-                new_sensor_data_df = new_sensor_data_df[columns_order]
+                columns_order = ['dateTime'] + [col for col in temp_sensor_data[0].keys() if col != 'dateTime']
 
-                try:
-                    existing_sensor_data = pd.read_csv(sensor_data_filename)
-                    joint_sensor_data = pd.concat([existing_sensor_data, new_sensor_data_df])
+                with span("write_sensor_report", file=file_name):
                     try:
-                        joint_sensor_data.to_csv(sensor_data_filename, index=False)
-                        print(f"\tSuccessfully added sensor data to file: {sensor_data_filename}.\n")
+                        if write_report(temp_sensor_data, columns_order, sensor_data_filename):
+                            print(f"\tSuccessfully created a new sensor data report. It was saved to: {sensor_data_filename}.\n")
+                        else:
+                            print(f"\tSuccessfully added sensor data to file: {sensor_data_filename}.\n")
                     except Exception as e:
                         print(f"\t\tAn error occurred while saving the new sensor data report in: {sensor_data_filename}: {e}")
-                except FileNotFoundError:
-                    # If there is no existing weight report for this bird, use current data to form a new report.
-                    new_sensor_data_df.to_csv(sensor_data_filename, index=False)
-                    print(f"\tSuccessfully created a new sensor data report. It was saved to: {sensor_data_filename}.\n")
 
                 # Reset temporary data array
                 temp_sensor_data = [] 
@@ -642,10 +714,6 @@ if __name__ == "__main__":
                 print(f"\tWriting scale data to disk...")
                 path_to_weight_reports = os.path.join(config_data["scaleOutputBasePath"], "weight_reports")
 
-                # This dataframe will contain the current temporary time and weight data from all active scales
-                scale_df = pd.DataFrame()
-                # Create the time column once as it is similar for all
-                scale_df['Time'] = [item[0] for item in scale_readings] 
 
                 # Iterate through all birds, if they have an active scale, add the new collected data to the weight report
                 for i in range(8):
@@ -655,27 +723,21 @@ if __name__ == "__main__":
                     else:
                         bird = bird_catalog[f"channel{i}"]
                         print(f"\t\tbird '{bird}' in channel {i}, writing it's temporary scale data...")
-                        # Collect data for current bird into DataFrame.
-                        scale_df[bird] = [item[1][i] for item in scale_readings]
-                        new_bird_data = scale_df[["Time", f"{bird}"]]
-                        # Build path to weight reports folder and create a folder for the current bird if it doesn't exist:
+                        # Collect the time and weight data of the current bird.
+                        new_bird_data = [{"Time": item[0], bird: item[1][i]} for item in scale_readings]
+                        # Build path to the current bird's folder in the weight reports folder (it's created with the first report):
                         path_to_current_bird = os.path.join(path_to_weight_reports, bird)
-                        os.makedirs(path_to_current_bird, exist_ok=True) 
                     
                         # date_today = datetime.datetime.now().strftime("%Y_%m_%d") # current date
                         weight_report_filename = os.path.join(path_to_current_bird, f"{bird}_weight_report.csv")
-                        try:
-                            existing_bird_data = pd.read_csv(weight_report_filename)
-                            joint_bird_data = pd.concat([existing_bird_data, new_bird_data], ignore_index=True)
+                        with span("write_weight_report", bird=bird):
                             try:
-                                joint_bird_data.to_csv(weight_report_filename, index=False)
-                                print(f"\t\tSuccessfully added temporary scale data for bird: {bird}.")
+                                if write_report(new_bird_data, ["Time", bird], weight_report_filename):
+                                    print(f"\tSuccessfully created a new weight report for bird: {bird}. It was saved to: {weight_report_filename}.\n")
+                                else:
+                                    print(f"\t\tSuccessfully added temporary scale data for bird: {bird}.")
                             except Exception as e:
                                 print(f"\t\tAn error occurred while saving the new weight report for bird {bird}: {e}")
-                        except FileNotFoundError:
-                            # If there is no existing weight report for this bird, use current data to form a new report.
-                            new_bird_data.to_csv(weight_report_filename, index=False)
-                            print(f"\tSuccessfully created a new weight report for bird: {bird}. It was saved to: {weight_report_filename}.\n")
                     
                 # Reset temporary scale data array
                 scale_readings = []
@@ -688,7 +750,7 @@ if __name__ == "__main__":
             # Once a day, weight reports from all monitored birds will be slacked according to user choice.
             # Check if user entered a time (HH:MM), If not - continue without slacking.
             if config_data["sendWeightReportToSlackTime"] is not None:
-                now = datetime.datetime.now()
+                now = clock.now()
                 time_from_last_slacking = (now - last_slacking_time).total_seconds() / 60
                 # Check if it's time to send daily weight reports to slack:
                 # 1. Check if current hours & minutes match target hours & minutes.
@@ -712,14 +774,78 @@ if __name__ == "__main__":
                             # send daily csv report to slack
                             try:
                                 send_file_to_slack(slack_client, weight_report_filename)
-                                last_slacking_time = datetime.datetime.now()
+                                last_slacking_time = clock.now()
                                 print(f"\t\tSuccesfully slacked daily weight report for bird {birdname}!")
                             except Exception as e:
                                     print(f"\t\t\tAn error occurred while slacking daily weight report for bird {birdname}: {e}")
     
         else:
             print('User chose not to print and save data at all')
-            time.sleep(60)
-            
+            # The alerts still need readings, so we check a single fresh reading every minute.
+            if alert_engine is not None:
+                with span("get_arduino_data"):
+                    data = get_latest_arduino_data(serial_device, clock=clock)
+                if data is None:
+                    print(f"\tNo valid reading from the Arduino after {LATEST_DATA_MAX_READS} tries, skipping the alerts check this minute")
+                else:
+                    with span("alerts"):
+                        alert_engine.evaluate(data, clock.now(), light_state=LAST_LIGHT_SWITCH_STATE)
+            clock.sleep(60)
+
+        if on_cycle is not None:
+            on_cycle()
+
+
+if __name__ == "__main__":
+    print("Hello! This is the Arduino controller script!\n")
+
+    ## Part 1 - parse the config file
+    parser = ArgumentParser()
+
+    # `config` actually IS a required variable, but this way it'll be easier to raise a custom error when it isn't supplied
+    parser.add_argument("--config", required=False, help="The path for the config file we're working with.")
+    args = parser.parse_args()
+
+    config_path = args.config
+    config_path = r'/Users/cohenlab/Documents/GitHub_Yuval/acoustic_chamber_environment_control/config_files/config_1.yaml'
+    if config_path is None:
+        raise Exception("No config file was supplied! Please rerun and add `--config=/path/to/config` ")
+
+    config_data = read_config(config_path)
+    print(f"Working with config file `{config_path}`, which contains - ")
+    print(yaml.dump(config_data)) # This is just a trick to print the YAML content in a nicer way
+
+    # Tracing & profiling are debugging tools, so they are off unless an output path is given in the config file.
+    if config_data.get("traceOutputPath") is not None:
+        start_tracing(config_data["traceOutputPath"])
+    if config_data.get("profileOutputPath") is not None:
+        enable_profile_on_signal(config_data["profileOutputPath"], duration=config_data.get("profileSeconds") or DEFAULT_PROFILE_SECONDS)
+
+    ## Part 2 - Initialize Slack
+    try:
+        slack_client = WebClient(token=SLACK_TOKEN)
+        print("\tSuccessfully initialized Slack client")
+    except Exception as err:
+        print(f"Failed initializing Slack client - `{err}`")
+        sys.exit(1)
         
+    ## Part 3 - Connect to the serial device
+    try:
+        serial_device = get_serial_device()
+        print("\tSuccessfully connected to Serial device")
+    except Exception as err:
+        print(f"Failed connecting to the Serial device - `{err}`")
+        sys.exit(1)
+    
+    ## Part 4 - Initialize a Weizmann location object for the Astral package
+    try:
+        wis_location_info = get_weizmann_location_object()
+        print("\tSuccessfully initialized the location object for WIS")
+    except Exception as err:
+        print(f"Failed initializing the location object - `{err}`")
+        sys.exit(1)
+    
+    print("\n")
 
+    ## Part 5 - This is the main part of the code, which runs in a loop and reads data from sensors, and controls the light switch.
+    run_control_loop(config_data, serial_device, wis_location_info, slack_client)
@@ -0,0 +1,189 @@
+import datetime
+import os
+import time
+import random
+import tempfile
+import contextlib
+from argparse import ArgumentParser
+import pandas as pd
+
+import control_main
+from control_main import read_config, get_weizmann_location_object, create_filename_for_data_report, run_control_loop, ON_TOKEN, \
+    append_to_csv_report
+from clock import SimulatedClock
+
+TIMELINE_FIELD_NAMES = ['simulated_time', 'event', 'details']
+
+# Typical readings of the sentinel chamber, used by the fake serial device.
+SIMULATED_HUMIDITY = 45.0
+SIMULATED_TEMPERATURE = 24.0
+SIMULATED_PHOTORESISTOR_ON = 800.0
+SIMULATED_PHOTORESISTOR_OFF = 20.0
+SIMULATED_BIRD_WEIGHT = 25.0
+
+# The fake serial device cycles through this many pre-built lines, instead of formatting a new line on every reading.
+SIMULATED_LINES_PER_LIGHT_STATE = 997
+
+# The buffered report writer saves a report once it holds this many new rows (~1 day of weight readings of a bird).
+REPORT_BUFFER_MAX_ROWS = 24 * 60 * 60
+
+
+class FakeSerialDevice:
+    """
+    Acts like the Arduino serial device. It always has a line ready to read, built like the lines of `arduino_code_1`
+    (humidity;temprature;photoresistor;8 scale readings;), and records every light switch in the timeline.
+    The photoresistor follows the last light command, and the channels with a bird return its weight.
+    """
+    def __init__(self, clock, timeline, active_channels):
+        self.clock = clock
+        self.timeline = timeline
+        self.light_token = None
+        self.in_waiting = 1
+        self.lines = {light_on: [self.build_line(light_on, active_channels) for _ in range(SIMULATED_LINES_PER_LIGHT_STATE)]
+                      for light_on in (True, False)}
+        self.line_index = 0
+
+    @staticmethod
+    def build_line(light_on, active_channels):
+        photoresistor = SIMULATED_PHOTORESISTOR_ON if light_on else SIMULATED_PHOTORESISTOR_OFF
+        weights = [SIMULATED_BIRD_WEIGHT + random.uniform(-0.5, 0.5) if i in active_channels else 0.0 for i in range(8)]
+        values = [SIMULATED_HUMIDITY, SIMULATED_TEMPERATURE, photoresistor] + weights
+        return (";".join(f"{value:.2f}" for value in values) + ";\r\n").encode("utf-8")
+
+    def write(self, token):
+        if token != self.light_token:
+            state = "ON" if token == ON_TOKEN else "OFF"
+            self.timeline.append((self.clock.now(), f"light {state}", f"token {token}"))
+            self.light_token = token
+
+    def reset_input_buffer(self):
+        pass
+
+    def readline(self):
+        self.line_index = (self.line_index + 1) % SIMULATED_LINES_PER_LIGHT_STATE
+        return self.lines[self.light_token == ON_TOKEN][self.line_index]
+
+
+class FakeSlackResponse(dict):
+    status_code = 200
+
+
+class FakeSlackClient:
+    """
+    Acts like the slack WebClient, recording every message and file upload in the timeline instead of sending it.
+    """
+    def __init__(self, clock, timeline):
+        self.clock = clock
+        self.timeline = timeline
+
+    def chat_postMessage(self, channel, text):
+        self.timeline.append((self.clock.now(), "slack message", text))
+        return FakeSlackResponse()
+
+    def files_upload_v2(self, file, channel, filename):
+        self.timeline.append((self.clock.now(), "slack file", filename))
+        return FakeSlackResponse(file={"id": f"simulated_{filename}"})
+
+
+class BufferedReportWriter:
+    """
+    Replaces `append_to_csv_report` in the simulation. The first rows of every report are written right away, so the
+    report exists (and its creation is reported) at the same simulated time as in the real loop. Later rows are kept
+    in memory and appended to the report in large batches, which makes a simulated year much faster.
+    Call `flush` at the end of the simulation to save the remaining rows.
+    """
+    def __init__(self, max_rows=REPORT_BUFFER_MAX_ROWS):
+        self.max_rows = max_rows
+        self.buffers = {}
+
+    def __call__(self, rows, field_names, path_to_file):
+        if path_to_file not in self.buffers:
+            self.buffers[path_to_file] = (field_names, [])
+            return append_to_csv_report(rows, field_names, path_to_file)
+
+        buffered_rows = self.buffers[path_to_file][1]
+        buffered_rows.extend(rows)
+        if len(buffered_rows) >= self.max_rows:
+            self.flush_report(path_to_file)
+        return False
+
+    def flush_report(self, path_to_file):
+        field_names, buffered_rows = self.buffers[path_to_file]
+        if len(buffered_rows) > 0:
+            append_to_csv_report(buffered_rows, field_names, path_to_file)
+            buffered_rows.clear()
+
+    def flush(self):
+        for path_to_file in self.buffers:
+            self.flush_report(path_to_file)
+
+
+def simulate(config_data, start_time, days, output_path, sample_interval=60):
+    """
+    Replay the control loop (`run_control_loop`) with the given config, from `start_time` for `days` days,
+    against a simulated clock, a fake serial device and a fake slack client.
+    Reports are written under `output_path` instead of the paths in the config file.
+    Returns the timeline of light switches, report file rotations and slack messages as a DataFrame.
+    """
+    config_data = dict(config_data)
+    config_data["sensorOutputBasePath"] = os.path.join(output_path, "sensorData")
+    config_data["scaleOutputBasePath"] = os.path.join(output_path, "scaleData")
+
+    clock = SimulatedClock(start_time)
+    timeline = []
+    active_channels = [i for i in range(8) if config_data.get(f"channel{i}") is not None]
+    serial_device = FakeSerialDevice(clock, timeline, active_channels)
+    slack_client = FakeSlackClient(clock, timeline)
+
+    # Report file rotations are detected by comparing the sensor report name before and after every day change.
+    last_file_name = {"sensor": None, "date": None}
+    def on_cycle():
+        if (not config_data["sensorDataReadingAndSaving"]) or (clock.today() == last_file_name["date"]):
+            return
+        last_file_name["date"] = clock.today()
+        file_name = create_filename_for_data_report(config_data, clock=clock)
+        if file_name != last_file_name["sensor"]:
+            timeline.append((clock.now(), "sensor report rotation", file_name))
+            last_file_name["sensor"] = file_name
+
+    control_main.LAST_LIGHT_SWITCH_STATE = None
+    write_report = BufferedReportWriter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            run_control_loop(config_data, serial_device, get_weizmann_location_object(), slack_client, clock=clock,
+                             sample_interval=sample_interval, until=start_time + datetime.timedelta(days=days),
+                             on_cycle=on_cycle, write_report=write_report)
+        finally:
+            write_report.flush()
+
+    return pd.DataFrame(timeline, columns=TIMELINE_FIELD_NAMES)
+
+
+if __name__ == "__main__":
+    print("Hello! This is the control loop fast-forward simulation script!\n")
+
+    parser = ArgumentParser()
+    parser.add_argument("--config", required=True, help="The path for the config file we want to simulate.")
+    parser.add_argument("--start", default=None, help="The simulated start date, 'yyyy-mm-dd' (default - today).")
+    parser.add_argument("--days", type=int, default=365, help="The number of days to simulate.")
+    parser.add_argument("--output", default=None, help="The path to the folder where the simulated reports and the timeline will be saved (default - a temporary folder).")
+    parser.add_argument("--sample-interval", type=int, default=60, help="Simulated seconds between two Arduino readings. The real script reads every second; larger values make the simulation faster.")
+    args = parser.parse_args()
+
+    config_data = read_config(args.config)
+    start_time = datetime.datetime.strptime(args.start, "%Y-%m-%d") if args.start else datetime.datetime.combine(datetime.date.today(), datetime.time())
+    output_path = args.output if args.output else tempfile.mkdtemp(prefix="simulated_control_loop_")
+    os.makedirs(output_path, exist_ok=True)
+
+    print(f"\tSimulating {args.days} days from {start_time} with config file `{args.config}`...")
+    simulation_start_time = time.perf_counter()
+    timeline_df = simulate(config_data, start_time, args.days, output_path, sample_interval=args.sample_interval)
+    wall_time = time.perf_counter() - simulation_start_time
+
+    timeline_filename = os.path.join(output_path, "simulated_timeline.csv")
+    timeline_df.to_csv(timeline_filename, index=False)
+
+    print(timeline_df.to_string(index=False, max_rows=60))
+    print(f"\n\tEvents: {timeline_df['event'].value_counts().to_dict()}")
+    print(f"\tTimeline was saved to: {timeline_filename}")
+    print(f"\tSimulated {args.days} days in {round(wall_time, 2)} seconds")
@@ -0,0 +1,281 @@
+import os
+import random
+import datetime
+import collections
+
+from alerts import AlertEngine, ThresholdRule, RateOfChangeRule, BaselineDeviationRule, LightMismatchRule, build_alert_engine, ENVIRONMENT_CATEGORY, TEMPERATURE_FIELD, \
+    HUMIDITY_FIELD, PHOTORESISTOR_FIELD, SCALE_FIELD
+
+START_TIME = datetime.datetime(2024, 7, 16, 10, 0)
+
+
+class FiringRule:
+    """A rule that fires while `firing` is True."""
+    def __init__(self, name, category=ENVIRONMENT_CATEGORY):
+        self.name = name
+        self.category = category
+        self.firing = False
+
+    def check(self, sample, now, light_state):
+        return f"{self.name} is firing" if self.firing else None
+
+
+def make_sample(temperature=24.0, humidity=45.0, photoresistor=800.0, weights=None):
+    return {HUMIDITY_FIELD: humidity, TEMPERATURE_FIELD: temperature, PHOTORESISTOR_FIELD: photoresistor,
+            SCALE_FIELD: weights if weights is not None else [25.0] * 8, "dateTime": ""}
+
+
+def collect(sent):
+    """A `send_alert` that keeps the messages in `sent` and always succeeds."""
+    def send_alert(message):
+        sent.append(message)
+        return True
+    return send_alert
+
+
+def run_minutes(engine, start_minute, end_minute, sample=None):
+    for minute in range(start_minute, end_minute):
+        engine.evaluate(sample or make_sample(), START_TIME + datetime.timedelta(minutes=minute), light_state="ON")
+
+
+def test_alert_held_back_by_the_rate_limit_is_sent_once_a_token_is_available():
+    sent = []
+    rules = [FiringRule("a"), FiringRule("b"), FiringRule("c")]
+    engine = AlertEngine(rules, collect(sent), repeat_minutes=60, max_alerts_per_hour=2)
+    for rule in rules:
+        rule.firing = True
+
+    run_minutes(engine, 0, 1)
+    assert sent == ["ALERT in enviromental system 0 - a is firing", "ALERT in enviromental system 0 - b is firing"]
+
+    # A token is refilled every 30 minutes - `c` is sent then, not only after the 60 repeat minutes
+    run_minutes(engine, 1, 29)
+    assert len(sent) == 2
+    run_minutes(engine, 29, 32)
+    assert sent[2] == "ALERT in enviromental system 0 - c is firing (1 alerts were held back by the rate limit)"
+
+    # Once sent, `c` is deduplicated like any other alert
+    run_minutes(engine, 32, 59)
+    assert len(sent) == 3
+
+
+def test_resolved_is_only_sent_for_a_delivered_alert():
+    sent = []
+    rules = [FiringRule("a"), FiringRule("b")]
+    engine = AlertEngine(rules, collect(sent), resolve_minutes=5, max_alerts_per_hour=1)
+    for rule in rules:
+        rule.firing = True
+    run_minutes(engine, 0, 10)
+    assert sent == ["ALERT in enviromental system 0 - a is firing"]
+
+    # `b` cleared before it was sent, so there's nothing to resolve. `a` is resolved once a token is available.
+    for rule in rules:
+        rule.firing = False
+    run_minutes(engine, 10, 60)
+    assert len(sent) == 1
+    run_minutes(engine, 60, 61)
+    assert sent[1].startswith("RESOLVED in enviromental system 0 - a is back to normal")
+    run_minutes(engine, 61, 200)
+    assert len(sent) == 2
+
+
+def test_silent_scales_dont_hold_back_a_temperature_alert():
+    sent = []
+    config_data = {"env_system": 1, "alertMaxTemperature": 30,
+                   "alertScaleSilentMinutes": 60, "alertMaxPerHour": 3}
+    bird_catalog = {f"channel{i}": f"bird{i}" for i in range(8)}
+    engine = build_alert_engine(config_data, bird_catalog, collect(sent))
+
+    # All 8 scales go silent - a single alert lists all of them
+    run_minutes(engine, 0, 121, sample=make_sample(weights=[0.0] * 8))
+    assert len(sent) == 2 # The alert after 60 silent minutes, and its repeat after another 60 minutes
+    assert all(f"'bird{i}' (channel {i})" in sent[0] for i in range(8))
+
+    run_minutes(engine, 121, 123, sample=make_sample(temperature=35.0, weights=[0.0] * 8))
+    assert sent[-1] == "ALERT in enviromental system 1 - Temperature is 35.0, above the maximum of 30"
+
+
+def test_scale_limit_is_separate_from_the_environment_limit():
+    sent = []
+    scale_rules = [FiringRule(f"scale {i}", category="scale") for i in range(5)]
+    temperature_rule = ThresholdRule("Temperature", TEMPERATURE_FIELD, max_value=30, hold_seconds=0)
+    engine = AlertEngine(scale_rules + [temperature_rule], collect(sent), max_alerts_per_hour=3)
+    for rule in scale_rules:
+        rule.firing = True
+
+    run_minutes(engine, 0, 1, sample=make_sample(temperature=35.0))
+    assert sent == [f"ALERT in enviromental system 0 - scale {i} is firing" for i in range(3)] + \
+                  ["ALERT in enviromental system 0 - Temperature is 35.0, above the maximum of 30"]
+
+
+def test_threshold_must_hold_before_alerting():
+    rule = ThresholdRule("Temperature", TEMPERATURE_FIELD, max_value=30, hold_seconds=60)
+    readings = [24.0, 35.0, 24.0] + [35.0] * 30 + [float("nan")] + [35.0] * 40
+    messages = [rule.check(make_sample(temperature=temperature), START_TIME + datetime.timedelta(seconds=second), "ON")
+                for second, temperature in enumerate(readings)]
+
+    # The single glitch (second 1) is ignored, and the alert starts 60 seconds after the temperature went up (second 3)
+    assert [second for second, message in enumerate(messages) if message is not None] == list(range(63, len(readings)))
+
+
+def test_sustained_threshold_alert_is_sent_once():
+    sent = []
+    engine = build_alert_engine({"alertMaxTemperature": 30}, {}, collect(sent))
+    for second in range(600):
+        temperature = 35.0 if (second == 10) or (second >= 100) else 24.0
+        engine.evaluate(make_sample(temperature=temperature), START_TIME + datetime.timedelta(seconds=second), light_state="ON")
+    assert sent == ["ALERT in enviromental system 0 - Temperature is 35.0, above the maximum of 30"]
+
+
+def test_alerts_are_checked_when_data_saving_is_off(monkeypatch):
+    import control_main
+    import simulate_control_loop
+    from clock import SimulatedClock
+
+    monkeypatch.setattr(simulate_control_loop, "SIMULATED_TEMPERATURE", 35.0)
+    config_data = control_main.read_config(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config_files", "config_1.yaml"))
+    config_data.update({"sensorDataReadingAndSaving": 0, "scaleDataReadingAndSaving": 0,
+                        "sendWeightReportToSlackTime": None, "alertMaxTemperature": 30})
+
+    clock = SimulatedClock(START_TIME)
+    timeline = []
+    serial_device = simulate_control_loop.FakeSerialDevice(clock, timeline, active_channels=[])
+    slack_client = simulate_control_loop.FakeSlackClient(clock, timeline)
+    monkeypatch.setattr(control_main, "LAST_LIGHT_SWITCH_STATE", None)
+    control_main.run_control_loop(config_data, serial_device, control_main.get_weizmann_location_object(), slack_client,
+                                  clock=clock, until=START_TIME + datetime.timedelta(minutes=5))
+
+    messages = [details for _, event, details in timeline if event == "slack message"]
+    assert "ALERT in enviromental system 1 - Temperature is 35.0, above the maximum of 30" in messages
+
+
+def test_baseline_adapts_to_a_lasting_level_shift():
+    random.seed(1)
+    sent = []
+    engine = AlertEngine([BaselineDeviationRule("Temperature baseline", TEMPERATURE_FIELD, 4)], collect(sent),
+                         max_alerts_per_hour=1000)
+    alerts_per_day = collections.Counter()
+    for minute in range(30 * 24 * 60):
+        day, minute_of_day = divmod(minute, 24 * 60)
+        temperature = 24.0 + random.gauss(0, 0.1) + (1.0 if day >= 10 else 0.0) # 1 degree warmer from day 10 on
+        if (day == 25) and (5 * 60 <= minute_of_day < 7 * 60): # and a 2 hours overheating on day 25
+            temperature += 3.0
+        alerts_sent = len(sent)
+        engine.evaluate(make_sample(temperature=temperature), START_TIME + datetime.timedelta(minutes=minute))
+        alerts_per_day[day] += len(sent) - alerts_sent
+
+    # Noise alone doesn't alert, the shift alerts at first, and a few days later it's the new normal
+    assert sum(alerts_per_day[day] for day in range(10)) == 0
+    assert alerts_per_day[10] > 0
+    assert sum(alerts_per_day[day] for day in range(14, 25)) == 0
+    # The overheating on top of the new normal is still detected
+    assert any(message.startswith("ALERT") for message in sent[-alerts_per_day[25]:]) and alerts_per_day[25] > 0
+
+
+def test_baseline_deviation_must_hold_before_alerting():
+    rule = BaselineDeviationRule("Temperature baseline", TEMPERATURE_FIELD, 4, hold_seconds=60)
+    for second in range(0, 25 * 3600, 10): # A day of data, so every hour of the day has a baseline
+        rule.check(make_sample(temperature=24.0 + (0.1 if (second // 10) % 2 else -0.1)),
+                   START_TIME + datetime.timedelta(seconds=second), "ON")
+    glitch_time = START_TIME + datetime.timedelta(hours=25)
+    assert rule.check(make_sample(temperature=30.0), glitch_time, "ON") is None
+    assert rule.check(make_sample(temperature=24.0), glitch_time + datetime.timedelta(seconds=10), "ON") is None
+    messages = [rule.check(make_sample(temperature=30.0), glitch_time + datetime.timedelta(seconds=second), "ON")
+                for second in range(20, 100, 10)]
+    assert messages[:6] == [None] * 6 # 20..70 seconds - less than 60 seconds since the deviation started
+    assert messages[6].startswith("Temperature baseline is 30.0, while it is usually 24.0")
+
+
+def test_rate_of_change_over_and_under_the_limit():
+    rule = RateOfChangeRule("Temperature change", TEMPERATURE_FIELD, max_change_per_hour=3, window_minutes=10)
+    # 0.3 degrees per 10 minutes is 1.8 degrees per hour - under the limit
+    messages = [rule.check(make_sample(temperature=24.0 + 0.03 * minute), START_TIME + datetime.timedelta(minutes=minute), "ON")
+                for minute in range(31)]
+    assert messages == [None] * 31
+    # 1 degree per 10 minutes is 6 degrees per hour - the alert starts at the end of the first window
+    messages = [rule.check(make_sample(temperature=24.9 + 0.1 * minute), START_TIME + datetime.timedelta(minutes=30 + minute), "ON")
+                for minute in range(1, 21)]
+    assert messages[:9] == [None] * 9
+    assert messages[9].startswith("Temperature change is changing by")
+    assert all(message is not None for message in messages[9:])
+    # Back to a stable temperature - cleared at the end of the next window
+    messages = [rule.check(make_sample(temperature=26.9), START_TIME + datetime.timedelta(minutes=50 + minute), "ON")
+                for minute in range(1, 21)]
+    assert messages[-1] is None
+
+
+def test_light_mismatch_short_versus_long():
+    rule = LightMismatchRule("Light switch", on_threshold=500, mismatch_minutes=5)
+    # The light takes 2 minutes to turn on - no alert
+    messages = [rule.check(make_sample(photoresistor=20.0 if minute < 2 else 800.0), START_TIME + datetime.timedelta(minutes=minute), "ON")
+                for minute in range(10)]
+    assert messages == [None] * 10
+    # The light doesn't turn off - the alert starts after 5 minutes
+    messages = [rule.check(make_sample(photoresistor=800.0), START_TIME + datetime.timedelta(minutes=10 + minute), "OFF")
+                for minute in range(8)]
+    assert messages[:5] == [None] * 5
+    assert messages[5] == "Light switch: light was commanded OFF but the photoresistor reads 800.0 (light is ON) since 10:10"
+    # Light state isn't known yet (the script just started) - nothing to compare
+    assert rule.check(make_sample(photoresistor=800.0), START_TIME + datetime.timedelta(minutes=20), None) is None
+
+
+def test_latest_arduino_data_retries_timed_out_reads():
+    import control_main
+    from clock import SimulatedClock
+
+    class SlowSerialDevice:
+        """After the input buffer is reset, the next line only arrives after a few timed out reads."""
+        def __init__(self, timeouts):
+            self.lines = []
+            self.timeouts = timeouts
+
+        def reset_input_buffer(self):
+            self.lines = [b"0;12.5;3"] + [b""] * self.timeouts + [b"45.00;35.00;800.00;0.00;0.00;0.00;0.00;0.00;0.00;0.00;0.00;\r\n"]
+
+        def readline(self):
+            return self.lines.pop(0) if len(self.lines) > 0 else b""
+
+    clock = SimulatedClock(START_TIME)
+    data = control_main.get_latest_arduino_data(SlowSerialDevice(timeouts=2), clock=clock)
+    assert data[TEMPERATURE_FIELD] == 35.0
+    assert control_main.get_latest_arduino_data(SlowSerialDevice(timeouts=control_main.LATEST_DATA_MAX_READS), clock=clock) is None
+
+
+def test_failed_send_is_retried_without_using_the_rate_limit():
+    rule = FiringRule("Temperature")
+    attempts = []
+    results = [False, False, True]
+
+    def flaky_send_alert(message):
+        attempts.append(message)
+        return results.pop(0) if len(results) > 0 else True
+
+    engine = AlertEngine([rule], flaky_send_alert, repeat_minutes=60, max_alerts_per_hour=1)
+    rule.firing = True
+    run_minutes(engine, 0, 5)
+    # Retried on the next samples (not after repeat_minutes), and the failed posts didn't use up the single token
+    assert len(attempts) == 3
+    assert all("held back" not in message for message in attempts)
+    assert engine.rule_states["Temperature"]["last_sent"] == START_TIME + datetime.timedelta(minutes=2)
+    assert engine.buckets[ENVIRONMENT_CATEGORY]["tokens"] < 1
+
+
+def test_send_message_to_slack_reports_failures():
+    import control_main
+
+    class Response:
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+    class SlackClient:
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        def chat_postMessage(self, channel, text):
+            if self.status_code is None:
+                raise ConnectionError("No network")
+            return Response(self.status_code)
+
+    assert control_main.send_message_to_slack(SlackClient(200), "hello")
+    assert not control_main.send_message_to_slack(SlackClient(500), "hello")
+    assert not control_main.send_message_to_slack(SlackClient(None), "hello")
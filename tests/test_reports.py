@@ -0,0 +1,116 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+import control_main
+from control_main import append_to_csv_report, data_aggregation
+from clock import SimulatedClock
+
+
+def write_report_with_pandas(rows, field_names, path_to_file):
+    """
+    The way the control loop saved the reports before `append_to_csv_report` -
+    read the whole report, concatenate the new rows and re-write it.
+    """
+    new_df = pd.DataFrame(rows)[field_names]
+    try:
+        existing_df = pd.read_csv(path_to_file)
+        pd.concat([existing_df, new_df], ignore_index=True).to_csv(path_to_file, index=False)
+    except FileNotFoundError:
+        new_df.to_csv(path_to_file, index=False)
+
+
+def sensor_rows(minute, extra_fields=None):
+    row = {"dateTime": f"2024-07-16 10:{minute:02d}:00.000000", "humidity(%)_min": "44.1", "humidity(%)_max": "45.9",
+           "temprature(deg celsius)_median": "24.5"}
+    row.update(extra_fields or {})
+    return [row]
+
+
+@pytest.fixture
+def reports(tmp_path):
+    """Return a function that writes the same rows with both implementations and reads back the two reports."""
+    control_main.REPORT_HEADERS_CACHE.clear()
+    pandas_filename = str(tmp_path / "pandas_report.csv")
+    append_filename = str(tmp_path / "append_report.csv")
+
+    def write(rows, field_names):
+        write_report_with_pandas(rows, field_names, pandas_filename)
+        append_to_csv_report(rows, field_names, append_filename)
+        return pd.read_csv(pandas_filename), pd.read_csv(append_filename)
+    return write
+
+
+def test_append_matches_pandas_for_existing_report(reports):
+    field_names = list(sensor_rows(0)[0].keys())
+    for minute in range(5):
+        pandas_df, append_df = reports(sensor_rows(minute), field_names)
+    pd.testing.assert_frame_equal(pandas_df, append_df)
+    assert len(append_df) == 5
+
+
+def test_append_matches_pandas_when_new_columns_are_added(reports):
+    field_names = list(sensor_rows(0)[0].keys())
+    reports(sensor_rows(0), field_names)
+    reports(sensor_rows(1), field_names)
+
+    new_rows = sensor_rows(2, extra_fields={"photoresistor(milivolt)_max": "812.0"})
+    pandas_df, append_df = reports(new_rows, list(new_rows[0].keys()))
+    pd.testing.assert_frame_equal(pandas_df, append_df)
+    assert append_df["photoresistor(milivolt)_max"].isna().tolist() == [True, True, False]
+
+    # Rows without the new column are appended with an empty value again
+    pandas_df, append_df = reports(sensor_rows(3), field_names)
+    pd.testing.assert_frame_equal(pandas_df, append_df)
+
+
+def test_append_keeps_the_column_order_of_the_existing_report(reports):
+    field_names = list(sensor_rows(0)[0].keys())
+    reports(sensor_rows(0), field_names)
+    pandas_df, append_df = reports(sensor_rows(1), list(reversed(field_names)))
+    pd.testing.assert_frame_equal(pandas_df, append_df)
+    assert list(append_df.columns) == field_names
+
+
+def test_weight_report_matches_pandas(reports):
+    for minute in range(3):
+        rows = [{"Time": f"2024-07-16 10:{minute:02d}:{second:02d}.000000", "testy": 25.0 + second / 100}
+                for second in range(60)]
+        pandas_df, append_df = reports(rows, ["Time", "testy"])
+    pd.testing.assert_frame_equal(pandas_df, append_df)
+
+
+def test_data_aggregation_matches_pandas():
+    data_points = [{"dateTime": "", "humidity(%)": 45.0 + i / 10, "temprature(deg celsius)": 24.0 - i / 7,
+                    "photoresistor(milivolt)": float(800 + (i % 5))} for i in range(60)]
+    data_points[3]["humidity(%)"] = float("nan") # A failed DHT reading
+    for data_point in data_points:
+        data_point["temprature(deg celsius)"] = float("nan")
+
+    clock = SimulatedClock(datetime.datetime(2024, 7, 16, 10, 0))
+    aggregated_data = data_aggregation(data_points, clock=clock)
+
+    df = pd.DataFrame(data_points)
+    for field in ["humidity(%)", "temprature(deg celsius)", "photoresistor(milivolt)"]:
+        assert aggregated_data[f"{field}_min"] == str(df[field].min())
+        assert aggregated_data[f"{field}_max"] == str(df[field].max())
+        assert aggregated_data[f"{field}_median"] == str(df[field].median())
+    assert aggregated_data["dateTime"] == "2024-07-16 10:00"
+
+
+def test_buffered_simulation_writer_matches_append(tmp_path):
+    from simulate_control_loop import BufferedReportWriter
+
+    control_main.REPORT_HEADERS_CACHE.clear()
+    write_report = BufferedReportWriter(max_rows=3)
+    created = []
+    for minute in range(10):
+        created.append(write_report(sensor_rows(minute), list(sensor_rows(0)[0].keys()), str(tmp_path / "buffered.csv")))
+        append_to_csv_report(sensor_rows(minute), list(sensor_rows(0)[0].keys()), str(tmp_path / "append.csv"))
+    # The report is created by the first rows, even though the later rows are kept in memory
+    assert created == [True] + [False] * 9
+    write_report.flush()
+
+    with open(tmp_path / "buffered.csv") as buffered_file, open(tmp_path / "append.csv") as append_file:
+        assert buffered_file.read() == append_file.read()
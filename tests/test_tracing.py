@@ -0,0 +1,73 @@
+import os
+import glob
+import json
+import time
+import signal
+
+import pytest
+
+import tracing
+from tracing import span, start_tracing, stop_tracing, enable_profile_on_signal, NO_SPAN
+
+
+@pytest.fixture(autouse=True)
+def no_tracing_after_test():
+    yield
+    stop_tracing()
+
+
+def test_span_does_nothing_while_tracing_is_off():
+    assert tracing.TRACER is None
+    assert span("get_arduino_data", bird="testy") is NO_SPAN
+    with span("get_arduino_data"):
+        pass
+
+
+def test_trace_files_rotate_and_keep_backup_count(tmp_path):
+    tracer = start_tracing(str(tmp_path), max_bytes=500, backup_count=2)
+    for i in range(50):
+        with span("cycle", index=i):
+            with span("get_arduino_data"):
+                pass
+    assert tracer.files_opened > 3
+    stop_tracing()
+
+    trace_files = sorted(glob.glob(os.path.join(tmp_path, "trace_*.json")))
+    assert len(trace_files) == 3 # The last file and 2 backups
+    events = []
+    for trace_file in trace_files:
+        with open(trace_file) as f:
+            events += json.load(f)
+    assert all(event["ph"] == "X" for event in events)
+    assert all(isinstance(event["dur"], int) and event["dur"] >= 0 for event in events)
+    cycle_events = [event for event in events if event["name"] == "cycle"]
+    # The last cycle is in the last file, with its args
+    assert cycle_events[-1]["args"] == {"index": 49}
+    assert all("args" not in event for event in events if event["name"] == "get_arduino_data")
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1"), reason="SIGUSR1 is not supported on this platform")
+def test_sigusr1_writes_a_collapsed_stack_profile(tmp_path):
+    previous_handler = signal.getsignal(signal.SIGUSR1)
+    try:
+        enable_profile_on_signal(str(tmp_path), duration=0.3, interval=0.01)
+        os.kill(os.getpid(), signal.SIGUSR1)
+
+        def busy_loop():
+            end_time = time.perf_counter() + 2
+            while (time.perf_counter() < end_time) and (len(glob.glob(os.path.join(tmp_path, "profile_*.txt"))) == 0):
+                sum(range(1000))
+        busy_loop()
+        time.sleep(0.1) # Let the profiler thread finish writing the file
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+
+    profile_files = glob.glob(os.path.join(tmp_path, "profile_*.txt"))
+    assert len(profile_files) == 1
+    with open(profile_files[0]) as f:
+        lines = f.read().splitlines()
+    assert len(lines) > 0
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    assert any("busy_loop (test_tracing.py:" in line for line in lines)
@@ -0,0 +1,78 @@
+import os
+
+from weight_analytics import find_weight_reports, run_batch, process_bird
+
+
+def write_weight_report(system_dir, birdname, weight):
+    bird_dir = os.path.join(system_dir, "weight_reports", birdname)
+    os.makedirs(bird_dir)
+    with open(os.path.join(bird_dir, f"{birdname}_2024_07_01.csv"), "w") as f:
+        f.write(f"Time,{birdname}\n")
+        for hour in range(24):
+            f.write(f"2024-07-01 {hour:02d}:00:00.000000,{weight}\n")
+
+
+def test_systems_with_the_same_folder_name_are_kept_apart(tmp_path):
+    write_weight_report(tmp_path / "env1" / "scaleData", "testy", 20.0)
+    write_weight_report(tmp_path / "env2" / "scaleData", "testy", 30.0)
+
+    reports = find_weight_reports([str(tmp_path)])
+    assert sorted(env_system for env_system, _, _ in reports) == [os.path.join("env1", "scaleData"),
+                                                                   os.path.join("env2", "scaleData")]
+    # Scanning each system separately gives the same keys
+    assert find_weight_reports([str(tmp_path / "env1" / "scaleData"), str(tmp_path / "env2" / "scaleData")]) == reports
+
+    output_path = tmp_path / "output"
+    summary_df = run_batch([str(tmp_path)], str(output_path), workers=2, min_day_completeness=0)
+    assert sorted(summary_df['latest_median_weight(g)']) == [20.0, 30.0]
+    assert summary_df['figure_file'].nunique() == 2
+    assert len(os.listdir(output_path / "cache")) == 2
+
+    # The second run uses the cache of each system instead of reprocessing the reports
+    summary_df = run_batch([str(tmp_path)], str(output_path), workers=2, min_day_completeness=0)
+    assert list(summary_df['new_bytes_processed']) == [0, 0]
+
+
+def test_single_system_keeps_its_folder_name(tmp_path):
+    write_weight_report(tmp_path / "scaleData", "testy", 20.0)
+    assert [env_system for env_system, _, _ in find_weight_reports([str(tmp_path / "scaleData")])] == ["scaleData"]
+
+
+def write_minutes(weight_report_filename, birdname, days_and_weights, minutes_per_day=24 * 60):
+    """Write a weight report with one reading a minute, `days_and_weights` is a list of (day of July, weight)."""
+    with open(weight_report_filename, "w") as f:
+        f.write(f"Time,{birdname}\n")
+        for day, weight in days_and_weights:
+            for minute in range(minutes_per_day):
+                f.write(f"2024-07-{day:02d} {minute // 60:02d}:{minute % 60:02d}:00.000000,{weight}\n")
+
+
+def test_weight_loss_check_skips_an_incomplete_last_day(tmp_path):
+    weight_report_filename = str(tmp_path / "testy.csv")
+    write_minutes(weight_report_filename, "testy", [(1, 25.0), (2, 25.0), (3, 25.0)])
+    # A run just after midnight - only the first (night time) minutes of the 4th day were recorded
+    with open(weight_report_filename, "a") as f:
+        for minute in range(10):
+            f.write(f"2024-07-04 00:{minute:02d}:00.000000,20.0\n")
+
+    # One reading a minute is 1/60 of the expected samples, so the full days are ~1.67% complete
+    row = process_bird("env1", "testy", weight_report_filename, str(tmp_path / "output"), min_day_completeness=1.0)
+    assert (row['checked_day'], row['last_day']) == ("2024-07-03", "2024-07-04")
+    assert row['weight_loss_alert'] == False
+
+    row = process_bird("env1", "testy", weight_report_filename, str(tmp_path / "output"), min_day_completeness=0)
+    assert (row['checked_day'], row['weight_loss_alert']) == ("2024-07-04", True)
+
+
+def test_replaced_report_is_processed_from_the_start(tmp_path):
+    weight_report_filename = str(tmp_path / "testy.csv")
+    output_path = str(tmp_path / "output")
+    write_minutes(weight_report_filename, "testy", [(1, 25.0), (2, 25.0)])
+    process_bird("env1", "testy", weight_report_filename, output_path, min_day_completeness=0)
+
+    # The report is replaced by a longer report of other days (e.g. restored from a backup)
+    write_minutes(weight_report_filename + ".new", "testy", [(10, 30.0), (11, 30.0), (12, 30.0)])
+    os.replace(weight_report_filename + ".new", weight_report_filename)
+    row = process_bird("env1", "testy", weight_report_filename, output_path, min_day_completeness=0)
+    assert (row['first_day'], row['last_day'], row['n_days']) == ("2024-07-10", "2024-07-12", 3)
+    assert row['latest_median_weight(g)'] == 30.0
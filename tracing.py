@@ -0,0 +1,210 @@
+import datetime
+import os
+import sys
+import json
+import time
+import glob
+import signal
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Default limits of the rotating trace files. At 1 Hz data collection the control loop produces ~100K
+# events a day, which is ~15MB of JSON, so by default we keep about the last 5 days of traces.
+DEFAULT_TRACE_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_TRACE_BACKUP_COUNT = 5
+
+DEFAULT_PROFILE_SECONDS = 30
+DEFAULT_PROFILE_INTERVAL = 0.005 # seconds between two stack samples
+
+trace_file_time_format = "%Y_%m_%d_%H_%M_%S"
+
+# The active tracer. It stays None unless tracing was enabled, so `span` costs almost nothing by default.
+TRACER = None
+
+
+class Tracer:
+    """
+    Writes spans to rotating files in the Chrome trace-event JSON format ("JSON Array Format"), which can be
+    opened with `chrome://tracing` or https://ui.perfetto.dev.
+
+    Every file is a JSON array of complete ("X") events. The array is only closed when the file is rotated or the
+    tracer is closed, which the trace viewers tolerate, so a file that belongs to a crashed run is still readable.
+    """
+    def __init__(self, output_path, max_bytes=DEFAULT_TRACE_MAX_BYTES, backup_count=DEFAULT_TRACE_BACKUP_COUNT):
+        self.output_path = output_path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.pid = os.getpid()
+        self.depth = 0
+        self.lock = threading.Lock()
+        self.file = None
+        self.file_size = 0
+        self.events_in_file = 0
+        self.files_opened = 0
+        os.makedirs(output_path, exist_ok=True)
+        self._open_new_file()
+
+    def _open_new_file(self):
+        # The running file index keeps the names unique (and sorted) even if we rotate twice in the same second.
+        file_name = f"trace_{datetime.datetime.now().strftime(trace_file_time_format)}_{self.pid}_{self.files_opened:04d}.json"
+        self.files_opened += 1
+        self.file_name = os.path.join(self.output_path, file_name)
+        self.file = open(self.file_name, "w")
+        self.file.write("[\n")
+        self.file_size = 2
+        self.events_in_file = 0
+
+        # Remove the oldest trace files, keeping the current file and `backup_count` older ones.
+        trace_files = sorted(glob.glob(os.path.join(self.output_path, "trace_*.json")))
+        for old_file in trace_files[:-(self.backup_count + 1)]:
+            try:
+                os.remove(old_file)
+            except OSError as err:
+                print(f"\tFailed removing old trace file {old_file} - {err}")
+
+    def _close_file(self):
+        self.file.write("\n]\n")
+        self.file.close()
+
+    def add_event(self, name, start_us, duration_us, args=None):
+        event = {"name": name, "ph": "X", "ts": start_us, "dur": duration_us, "pid": self.pid,
+                 "tid": threading.get_ident()}
+        if args:
+            event["args"] = args
+        line = json.dumps(event, default=str)
+        if self.events_in_file > 0:
+            line = ",\n" + line
+
+        with self.lock:
+            self.file.write(line)
+            self.file_size += len(line)
+            self.events_in_file += 1
+            # Flush once every top-level span ends, so we don't lose a whole cycle if the script crashes.
+            if self.depth == 0:
+                self.file.flush()
+            if self.file_size >= self.max_bytes:
+                self._close_file()
+                self._open_new_file()
+
+    def close(self):
+        with self.lock:
+            self._close_file()
+
+
+def start_tracing(output_path, max_bytes=DEFAULT_TRACE_MAX_BYTES, backup_count=DEFAULT_TRACE_BACKUP_COUNT):
+    """
+    Enable tracing. From now on, every `span` is written to the trace files in `output_path`.
+    """
+    global TRACER
+    TRACER = Tracer(output_path, max_bytes=max_bytes, backup_count=backup_count)
+    print(f"\tTracing is enabled, trace files will be saved to: {output_path}")
+    return TRACER
+
+
+def stop_tracing():
+    global TRACER
+    if TRACER is not None:
+        TRACER.close()
+        TRACER = None
+
+
+# Returned by `span` while tracing is disabled. A single reusable context manager is much cheaper than a generator.
+NO_SPAN = nullcontext()
+
+
+def span(name, **args):
+    """
+    Record the time spent inside the `with` block as a single trace event, e.g. -
+        with span("get_arduino_data"):
+            data = get_arduino_data(serial_device)
+
+    Keyword arguments are saved as the event's `args` and shown by the trace viewer.
+    When tracing is disabled this does nothing.
+    """
+    tracer = TRACER
+    if tracer is None:
+        return NO_SPAN
+    return traced_span(tracer, name, args)
+
+
+@contextmanager
+def traced_span(tracer, name, args):
+    tracer.depth += 1
+    start_us = time.time_ns() // 1000
+    start_counter = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        duration_us = (time.perf_counter_ns() - start_counter) // 1000
+        tracer.depth -= 1
+        tracer.add_event(name, start_us, duration_us, args)
+
+
+def sample_stacks(thread_id, duration, interval):
+    """
+    Sample the call stack of the thread `thread_id` every `interval` seconds for `duration` seconds.
+    Returns a Counter of collapsed stacks ("outer_function;...;inner_function") to the number of samples.
+    """
+    stack_counts = Counter()
+    end_time = time.perf_counter() + duration
+    while time.perf_counter() < end_time:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None: # The sampled thread has finished
+            break
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        stack_counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stack_counts
+
+
+def write_profile(stack_counts, profile_filename):
+    """
+    Save the sampled stacks in the "collapsed stacks" format, one stack per line followed by its sample count.
+    This format can be opened with https://www.speedscope.app or rendered with `flamegraph.pl`.
+    """
+    with open(profile_filename, "w") as f:
+        for stack, count in stack_counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def enable_profile_on_signal(output_path, duration=DEFAULT_PROFILE_SECONDS, interval=DEFAULT_PROFILE_INTERVAL):
+    """
+    Install a SIGUSR1 handler that profiles the running script without restarting it.
+    Sending the signal (`kill -USR1 <pid>`) samples the main thread's stack for `duration` seconds,
+    in a background thread, and saves the result to `output_path`.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        print("\tProfiling on signal is not supported on this platform (no SIGUSR1), skipping.")
+        return
+
+    os.makedirs(output_path, exist_ok=True)
+    main_thread_id = threading.main_thread().ident
+    profiler_state = {"running": False}
+
+    def profile_in_background():
+        start_time = datetime.datetime.now()
+        try:
+            stack_counts = sample_stacks(main_thread_id, duration, interval)
+            profile_filename = os.path.join(output_path, f"profile_{start_time.strftime(trace_file_time_format)}.txt")
+            write_profile(stack_counts, profile_filename)
+            print(f"\tSaved a {duration} seconds profile ({sum(stack_counts.values())} samples) to: {profile_filename}")
+        except Exception as err:
+            print(f"\tFailed profiling - {err}")
+        finally:
+            profiler_state["running"] = False
+
+    def handle_signal(signum, frame):
+        if profiler_state["running"]:
+            print("\tA profile is already being recorded, ignoring the signal.")
+            return
+        profiler_state["running"] = True
+        print(f"\tReceived SIGUSR1, profiling for {duration} seconds...")
+        threading.Thread(target=profile_in_background, name="signal_profiler", daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, handle_signal)
+    print(f"\tProfiling on signal is enabled. Run `kill -USR1 {os.getpid()}` to save a {duration} seconds profile to: {output_path}")
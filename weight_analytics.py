@@ -0,0 +1,361 @@
+import datetime
+import os
+import io
+import json
+import time
+import glob
+import hashlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import numpy as np
+import matplotlib
+matplotlib.use("Agg") # The batch job runs headless (nightly cron / many worker processes), so we never open a window
+import matplotlib.pyplot as plt
+
+from control_main import find_single_csv_file
+
+# The scale loop records one reading per second, so a complete day holds this many samples.
+EXPECTED_SAMPLES_PER_DAY = 24 * 60 * 60
+
+# Readings below this weight (grams) are treated as an empty scale (bird is not on the perch).
+DEFAULT_MIN_VALID_WEIGHT = 5.0
+
+# A bird is flagged if its latest daily median weight dropped by more than this percentage
+# relative to the highest daily median of the previous `DEFAULT_BASELINE_DAYS` days.
+DEFAULT_WEIGHT_LOSS_PCT = 10.0
+DEFAULT_BASELINE_DAYS = 7
+
+# Only days with at least this percentage of the expected samples are used for the weight loss check. Birds weigh
+# less at night, so a day that has only a few hours of data (e.g. today, on a run just after midnight) isn't
+# comparable to full days.
+DEFAULT_MIN_DAY_COMPLETENESS_PCT = 75.0
+
+# Bump this whenever the content of the per-day cache entries changes, so old caches are rebuilt.
+CACHE_VERSION = 2
+
+SUMMARY_FIELD_NAMES = ['env_system', 'bird', 'first_day', 'last_day', 'n_days', 'checked_day', 'latest_median_weight(g)',
+                       'baseline_weight(g)', 'weight_change(%)', 'weight_loss_alert', 'latest_day_completeness(%)',
+                       'mean_completeness(%)', 'new_bytes_processed', 'processing_time(s)', 'report_file', 'figure_file']
+
+
+def find_weight_reports(base_paths):
+    """
+    Scan the given base paths for bird weight reports.
+
+    Each base path can either be a `scaleOutputBasePath` (which contains a `weight_reports` folder),
+    a `weight_reports` folder itself, or any parent folder of several of those (e.g. a folder holding the
+    output of all environmental systems).
+    We return a list of (env_system, birdname, path_to_weight_report) tuples. Every environmental system
+    usually keeps its reports in a folder with the same name (e.g. `scaleData`), so `env_system` is the path of
+    the folder holding the `weight_reports` folder relative to the common parent of all the scanned systems
+    (e.g. `env1/scaleData`), which is unique for every system.
+    """
+    found_reports = []
+    seen_dirs = set()
+    for base_path in base_paths:
+        base_path = os.path.abspath(base_path)
+        if os.path.basename(base_path) == "weight_reports":
+            weight_report_dirs = [base_path]
+        else:
+            weight_report_dirs = sorted(glob.glob(os.path.join(base_path, "**", "weight_reports"), recursive=True))
+
+        for weight_report_dir in weight_report_dirs:
+            if weight_report_dir in seen_dirs:
+                continue
+            seen_dirs.add(weight_report_dir)
+
+            for path_to_current_bird in sorted(glob.glob(os.path.join(weight_report_dir, "*"))):
+                if not os.path.isdir(path_to_current_bird):
+                    continue
+                birdname = os.path.basename(path_to_current_bird)
+                weight_report_filename = find_single_csv_file(path_to_current_bird, name_type='full')
+                if weight_report_filename is None:
+                    continue
+                found_reports.append((os.path.dirname(weight_report_dir), birdname, weight_report_filename))
+
+    if len(found_reports) == 0:
+        return []
+    # We take the common parent of the folders *above* the systems' folders, so a single system keeps its folder name.
+    common_root = os.path.commonpath([os.path.dirname(system_dir) for system_dir, _, _ in found_reports])
+    return [(os.path.relpath(system_dir, common_root), birdname, weight_report_filename)
+            for system_dir, birdname, weight_report_filename in found_reports]
+
+
+def get_output_names(env_system, birdname, weight_report_filename):
+    """
+    Return (output_name, cache_name) for a bird.
+    `output_name` is the readable prefix of the bird's figure, e.g. `env1_scaleData_bird1`.
+    `cache_name` also holds a short hash of the bird's report folder, so the cache file stays unique and stable
+    even if different sets of systems are scanned on different runs.
+    """
+    output_name = f"{env_system.replace(os.sep, '_')}_{birdname}"
+    bird_dir = os.path.dirname(os.path.abspath(weight_report_filename))
+    cache_name = f"{birdname}_{hashlib.sha1(bird_dir.encode('utf-8')).hexdigest()[:12]}"
+    return output_name, cache_name
+
+
+def read_cache(cache_filename):
+    """
+    Read the per-bird cache file. Returns None if there is no (valid) cache.
+    """
+    try:
+        with open(cache_filename, "r") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if cache.get("version") != CACHE_VERSION:
+        return None
+    return cache
+
+
+def write_cache(cache_filename, cache):
+    """
+    Write the per-bird cache file atomically, so an interrupted run never leaves a corrupt cache behind.
+    """
+    temp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+    with open(temp_filename, "w") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(temp_filename, cache_filename)
+
+
+def summarize_days(chunk_df, min_valid_weight):
+    """
+    Receive a DataFrame with `Time` and `Weight` columns and return a dict of per-day results -
+        {"2024-07-16": {"n_samples": ..., "n_valid": ..., "median": ..., "min": ..., "max": ..., "completeness": ...}, ...}
+    Only readings above `min_valid_weight` are used for the weight statistics.
+    """
+    days = {}
+    for date, day_df in chunk_df.groupby("Date", sort=True):
+        valid_weights = day_df["Weight"][day_df["Weight"] > min_valid_weight]
+        day_results = {
+            "n_samples": int(len(day_df)),
+            "n_valid": int(len(valid_weights)),
+            "median": None,
+            "min": None,
+            "max": None,
+            "completeness": round(100 * min(len(day_df), EXPECTED_SAMPLES_PER_DAY) / EXPECTED_SAMPLES_PER_DAY, 2),
+        }
+        if len(valid_weights) > 0:
+            day_results["median"] = float(valid_weights.median())
+            day_results["min"] = float(valid_weights.min())
+            day_results["max"] = float(valid_weights.max())
+        days[date] = day_results
+    return days
+
+
+def hash_file_head(weight_report_filename):
+    """
+    Return a hash of the header and the first row of the weight report. These never change while the control loop
+    appends to the report, so a different hash means the report was replaced.
+    The hash only covers complete lines, so it doesn't change while the first row is still being written.
+    """
+    with open(weight_report_filename, "rb") as f:
+        head = f.readline()
+        first_row = f.readline()
+    if first_row.endswith(b"\n"):
+        head += first_row
+    elif not head.endswith(b"\n"):
+        head = b""
+    return hashlib.sha1(head).hexdigest()
+
+
+def read_new_rows(weight_report_filename, offset):
+    """
+    Read the weight report from byte `offset` onwards (the header line is always read from the beginning).
+
+    Returns (chunk_df, row_offsets), where `chunk_df` has the columns `Time`, `Weight` and `Date`, and
+    `row_offsets` holds the absolute byte offset of every row of `chunk_df` in the file.
+    """
+    with open(weight_report_filename, "rb") as f:
+        header = f.readline()
+        offset = max(offset, len(header))
+        f.seek(offset)
+        new_bytes = f.read()
+
+    # Ignore a last line that is still being written by the control loop - it'll be read on the next run.
+    last_newline = new_bytes.rfind(b"\n")
+    new_bytes = new_bytes[:last_newline + 1]
+
+    if len(new_bytes) == 0:
+        return pd.DataFrame(columns=["Time", "Weight", "Date"]), np.array([], dtype=np.int64)
+
+    newline_positions = np.flatnonzero(np.frombuffer(new_bytes, dtype=np.uint8) == ord("\n"))
+    row_offsets = offset + np.concatenate(([0], newline_positions[:-1] + 1))
+
+    # The weight report has 2 columns - `Time` and the bird's name. We rename the second one to `Weight`.
+    chunk_df = pd.read_csv(io.BytesIO(new_bytes), header=None, names=["Time", "Weight"], usecols=[0, 1],
+                           skip_blank_lines=False, dtype={"Time": str})
+    chunk_df["Weight"] = pd.to_numeric(chunk_df["Weight"], errors="coerce")
+    chunk_df["Date"] = chunk_df["Time"].str.slice(0, 10)
+
+    # Blank or malformed rows are dropped after the offsets were calculated, so the two stay aligned.
+    valid_rows = chunk_df["Time"].notna().to_numpy()
+    return chunk_df[valid_rows].reset_index(drop=True), row_offsets[valid_rows]
+
+
+def plot_growth_curve(days, title, fig_name_path):
+    """
+    Plot the daily median weight (with the daily min-max range) of a single bird and save it as a PNG.
+    """
+    dates = [datetime.datetime.strptime(date, "%Y-%m-%d") for date, day in days.items() if day["median"] is not None]
+    medians = [day["median"] for day in days.values() if day["median"] is not None]
+    mins = [day["min"] for day in days.values() if day["median"] is not None]
+    maxs = [day["max"] for day in days.values() if day["median"] is not None]
+
+    fig, ax = plt.subplots(figsize=(10, 5))
+    if len(dates) > 0:
+        ax.fill_between(dates, mins, maxs, color='tab:blue', alpha=0.2, label='daily min-max')
+        ax.plot(dates, medians, marker='o', linestyle='-', color='tab:blue', label='daily median')
+        ax.legend()
+    fig.autofmt_xdate(rotation=90)
+    ax.set_xlabel("date")
+    ax.set_ylabel("weight(g)")
+    plt.title(f"{title}")
+    plt.tight_layout()
+    plt.savefig(fig_name_path)
+    plt.close(fig)
+
+
+def process_bird(env_system, birdname, weight_report_filename, output_path, min_valid_weight=DEFAULT_MIN_VALID_WEIGHT,
+                 weight_loss_pct=DEFAULT_WEIGHT_LOSS_PCT, baseline_days=DEFAULT_BASELINE_DAYS,
+                 min_day_completeness=DEFAULT_MIN_DAY_COMPLETENESS_PCT):
+    """
+    Process the weight report of a single bird and return its summary row (a dict with `SUMMARY_FIELD_NAMES` keys).
+    This function runs inside a worker process, so it only receives and returns plain (picklable) values.
+
+    Per-day results are cached in `output_path/cache`. The weight report only grows (the control loop appends
+    new rows every minute), so the cache keeps the byte offset where the last - possibly incomplete - day starts.
+    On the next run we only read the file from that offset on. If the file shrank or was replaced (a different
+    inode, or a different header & first row), we start over.
+
+    The weight loss check uses the last day that has at least `min_day_completeness` percent of the expected
+    samples (`checked_day`), compared to the complete days before it.
+    """
+    start_time = time.perf_counter()
+    output_name, cache_name = get_output_names(env_system, birdname, weight_report_filename)
+
+    cache_dir = os.path.join(output_path, "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_filename = os.path.join(cache_dir, f"{cache_name}.json")
+    cache = read_cache(cache_filename)
+
+    file_stats = os.stat(weight_report_filename)
+    file_head_hash = hash_file_head(weight_report_filename)
+    if (cache is None) or (cache["source"] != weight_report_filename) or (file_stats.st_size < cache["size"]) \
+            or (cache["inode"] != file_stats.st_ino) or (cache["head_hash"] != file_head_hash) \
+            or (cache["min_valid_weight"] != min_valid_weight):
+        cache = {"version": CACHE_VERSION, "source": weight_report_filename, "min_valid_weight": min_valid_weight,
+                 "inode": file_stats.st_ino, "head_hash": file_head_hash, "size": 0, "mtime": 0, "resume_offset": 0,
+                 "days": {}}
+
+    new_bytes_processed = 0
+    if (file_stats.st_size != cache["size"]) or (file_stats.st_mtime != cache["mtime"]):
+        chunk_df, row_offsets = read_new_rows(weight_report_filename, cache["resume_offset"])
+        new_bytes_processed = file_stats.st_size - cache["resume_offset"]
+
+        if len(chunk_df) > 0:
+            # The cached last day is recalculated from scratch, together with all new days.
+            cache["days"].update(summarize_days(chunk_df, min_valid_weight))
+            last_day = chunk_df["Date"].iloc[-1]
+            first_row_of_last_day = int(np.argmax(chunk_df["Date"].to_numpy() == last_day))
+            cache["resume_offset"] = int(row_offsets[first_row_of_last_day])
+
+        cache["size"] = file_stats.st_size
+        cache["mtime"] = file_stats.st_mtime
+        write_cache(cache_filename, cache)
+
+    days = dict(sorted(cache["days"].items()))
+
+    # Weight loss check - compare the median of the last complete day to the heaviest daily median of the complete days before it.
+    complete_days = [(date, day["median"]) for date, day in days.items()
+                     if (day["median"] is not None) and (day["completeness"] >= min_day_completeness)]
+    checked_day, latest_median = complete_days[-1] if len(complete_days) > 0 else (None, None)
+    baseline = None
+    weight_change = None
+    if len(complete_days) > 1:
+        baseline = max(median for date, median in complete_days[-(baseline_days + 1):-1])
+        weight_change = round(100 * (latest_median - baseline) / baseline, 2)
+    weight_loss_alert = (weight_change is not None) and (weight_change < -weight_loss_pct)
+
+    figure_filename = os.path.join(output_path, f"{output_name}_growth.png")
+    plot_growth_curve(days, title=f"{birdname} ({env_system}) - daily weight", fig_name_path=figure_filename)
+
+    completeness = [day["completeness"] for day in days.values()]
+    return {
+        'env_system': env_system,
+        'bird': birdname,
+        'first_day': next(iter(days), None),
+        'last_day': next(reversed(days), None),
+        'n_days': len(days),
+        'checked_day': checked_day,
+        'latest_median_weight(g)': latest_median,
+        'baseline_weight(g)': baseline,
+        'weight_change(%)': weight_change,
+        'weight_loss_alert': weight_loss_alert,
+        'latest_day_completeness(%)': completeness[-1] if len(completeness) > 0 else None,
+        'mean_completeness(%)': round(float(np.mean(completeness)), 2) if len(completeness) > 0 else None,
+        'new_bytes_processed': new_bytes_processed,
+        'processing_time(s)': round(time.perf_counter() - start_time, 3),
+        'report_file': weight_report_filename,
+        'figure_file': figure_filename,
+    }
+
+
+def run_batch(base_paths, output_path, workers=None, **process_bird_kwargs):
+    """
+    Process all birds found under `base_paths` in parallel (one bird per task, using a process pool),
+    and write the summary table to `output_path`. Returns the summary DataFrame.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    reports = find_weight_reports(base_paths)
+    print(f"\tFound {len(reports)} weight reports")
+
+    summary_rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_bird, env_system, birdname, weight_report_filename, output_path,
+                                   **process_bird_kwargs): (env_system, birdname)
+                   for env_system, birdname, weight_report_filename in reports}
+        for future in as_completed(futures):
+            env_system, birdname = futures[future]
+            try:
+                row = future.result()
+            except Exception as err:
+                print(f"\t\tFailed processing bird '{birdname}' in {env_system} - {err}")
+                continue
+            summary_rows.append(row)
+            print(f"\t\tProcessed bird '{birdname}' in {env_system} in {row['processing_time(s)']} seconds "
+                  f"({row['new_bytes_processed']} new bytes)")
+
+    summary_df = pd.DataFrame(summary_rows, columns=SUMMARY_FIELD_NAMES).sort_values(['env_system', 'bird'])
+    summary_filename = os.path.join(output_path, f"weight_summary_{datetime.datetime.now().strftime('%Y_%m_%d')}.csv")
+    summary_df.to_csv(summary_filename, index=False)
+    print(f"\tSummary table was saved to: {summary_filename}")
+    return summary_df
+
+
+if __name__ == "__main__":
+    print("Hello! This is the weight reports batch analytics script!\n")
+
+    parser = ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="Paths to scan for `weight_reports` folders (e.g. the `scaleOutputBasePath` of every environmental system).")
+    parser.add_argument("--output", required=True, help="The path to the folder where the summary table, figures and cache will be saved.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default - number of CPU cores).")
+    parser.add_argument("--min-weight", type=float, default=DEFAULT_MIN_VALID_WEIGHT, help="Readings below this weight (g) are treated as an empty scale.")
+    parser.add_argument("--weight-loss-pct", type=float, default=DEFAULT_WEIGHT_LOSS_PCT, help="Flag birds whose weight dropped by more than this percentage.")
+    parser.add_argument("--baseline-days", type=int, default=DEFAULT_BASELINE_DAYS, help="Number of previous days used as the weight baseline.")
+    parser.add_argument("--min-day-completeness", type=float, default=DEFAULT_MIN_DAY_COMPLETENESS_PCT, help="Only days with at least this percentage of the expected samples are used for the weight loss check.")
+    args = parser.parse_args()
+
+    batch_start_time = time.perf_counter()
+    summary_df = run_batch(args.paths, args.output, workers=args.workers, min_valid_weight=args.min_weight,
+                           weight_loss_pct=args.weight_loss_pct, baseline_days=args.baseline_days,
+                           min_day_completeness=args.min_day_completeness)
+
+    alerts = summary_df[summary_df['weight_loss_alert'] == True]
+    for _, row in alerts.iterrows():
+        print(f"WEIGHT LOSS ALERT - bird '{row['bird']}' in {row['env_system']}: {row['weight_change(%)']}% "
+              f"(median of {row['checked_day']} {row['latest_median_weight(g)']}g, baseline {row['baseline_weight(g)']}g)")
+
+    print(f"\nProcessed {len(summary_df)} birds in {round(time.perf_counter() - batch_start_time, 2)} seconds "
+          f"(total per-bird time {round(summary_df['processing_time(s)'].sum(), 2)} seconds)")